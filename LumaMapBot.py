@@ -1,34 +1,63 @@
 import os
 import json
 import hashlib
+import hmac
 import re
 import asyncio
+import atexit
+import base64
+import fcntl
+import bisect
+import threading
+import multiprocessing
+import time
+import sqlite3
+import struct
 import qrcode
+from PIL import Image, ImageDraw, ImageFont
 import uuid
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from io import BytesIO
 from datetime import datetime
 from types import SimpleNamespace
 from dotenv import load_dotenv
 from telegram.ext import (
     Application,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
+    TypeHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
 )
 from telegram.ext import filters
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardRemove,
     InputFile,
+    InputMediaPhoto,
 )
 
 load_dotenv()
 TOKEN = os.getenv('BOT_TOKEN')
 
+# Журнал изменений users.json: fsync пачками, сжатие в снапшот в фоне
+USER_JOURNAL_FSYNC_INTERVAL = float(os.getenv('USER_JOURNAL_FSYNC_INTERVAL', '1.0'))
+USER_JOURNAL_FSYNC_BATCH = int(os.getenv('USER_JOURNAL_FSYNC_BATCH', '50'))
+USER_JOURNAL_COMPACT_AFTER = int(os.getenv('USER_JOURNAL_COMPACT_AFTER', '1000'))
+
+# Хранилище: "json" — файлы как раньше, "sqlite" — одна база в режиме WAL
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'lumamap.db')
+
 FULLNAME, EMAIL, PHONE, PASSWORD, CONFIRM_PASSWORD = range(5)
 LOGIN_EMAIL, LOGIN_PASSWORD = range(5, 7)
 EDIT_FULLNAME, EDIT_EMAIL, EDIT_PHONE = range(7, 10)
@@ -38,6 +67,51 @@ FILTER_PRICE = range(100)
 CHOOSE_TICKET_QTY, CONFIRM_PAYMENT = range(200, 202)
 NEWS_DESCRIPTION, NEWS_IMAGE = range(300, 302)
 
+# Сколько мероприятий/новостей показывать на одной странице ленты
+FEED_PAGE_SIZE = int(os.getenv('FEED_PAGE_SIZE', '5'))
+# Отправлять картинки ленты альбомами (send_media_group) вместо отдельных send_photo
+FEED_MEDIA_GROUPS = os.getenv('FEED_MEDIA_GROUPS', '0') == '1'
+MEDIA_GROUP_LIMIT = 10
+
+# QR-коды билетов рисуются вне event loop: "process" — пул процессов, "thread" — пул потоков
+QR_EXECUTOR = os.getenv('QR_EXECUTOR', 'thread')
+QR_WORKERS = int(os.getenv('QR_WORKERS', str(os.cpu_count() or 2)))
+# Готовые PNG билетов держим в памяти, сколько влезает в этот объём
+QR_CACHE_BYTES = int(os.getenv('QR_CACHE_BYTES', str(16 * 1024 * 1024)))
+# Как отдавать билеты заказа: "single" — по фото на билет, "sheet" — лист с сеткой QR, "album" — альбомы по 10
+TICKET_DELIVERY = os.getenv('TICKET_DELIVERY', 'single')
+TICKET_SHEET_COLUMNS = 4
+TICKET_SHEET_ROWS = 6
+TICKET_SHEET_CELL = 300
+# Сколько держится бронь мест, пока покупатель оформляет заказ, и пока ждём подтверждения оплаты
+RESERVATION_TTL = int(os.getenv('RESERVATION_TTL', '600'))
+PAYMENT_HOLD_TTL = int(os.getenv('PAYMENT_HOLD_TTL', str(24 * 3600)))
+# Сколько билетов можно купить одним заказом
+MAX_TICKETS_PER_ORDER = int(os.getenv('MAX_TICKETS_PER_ORDER', '20'))
+# Как часто искать заявки на оплату, которые так и не подтвердили за PAYMENT_HOLD_TTL
+PAYMENT_SWEEP_INTERVAL = int(os.getenv('PAYMENT_SWEEP_INTERVAL', '60'))
+# Массовая выдача билетов после /confirm: сообщений в секунду на всех и сколько покупателей обслуживать одновременно
+DELIVERY_RATE = float(os.getenv('DELIVERY_RATE', '25'))
+DELIVERY_CONCURRENCY = int(os.getenv('DELIVERY_CONCURRENCY', '8'))
+# Сессии: через сколько секунд бездействия user_data и незавершённые диалоги пользователя
+# выкидываются из памяти, как часто это проверять, предел размера user_data одного пользователя
+SESSION_IDLE_TIMEOUT = int(os.getenv('SESSION_IDLE_TIMEOUT', str(6 * 3600)))
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', '300'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(16 * 1024)))
+SESSION_MAX_TRACKED_MESSAGES = int(os.getenv('SESSION_MAX_TRACKED_MESSAGES', '50'))
+# Незавершённый диалог (регистрация, покупка, создание афиши) сбрасывается через столько секунд
+CONVERSATION_TIMEOUT = int(os.getenv('CONVERSATION_TIMEOUT', '900'))
+
+# Комната ожидания: сколько человек в очереди максимум, как часто двигать очередь
+# и обновлять «ваше место», сколько секунд у впущенного покупателя на оформление
+WAITING_ROOM_MAX = int(os.getenv('WAITING_ROOM_MAX', '5000'))
+WAITING_ROOM_TICK = float(os.getenv('WAITING_ROOM_TICK', '2'))
+WAITING_ROOM_UPDATE_INTERVAL = float(os.getenv('WAITING_ROOM_UPDATE_INTERVAL', '10'))
+WAITING_ROOM_EDITS_PER_TICK = int(os.getenv('WAITING_ROOM_EDITS_PER_TICK', '20'))
+WAITING_ROOM_ADMIT_TTL = int(os.getenv('WAITING_ROOM_ADMIT_TTL', '300'))
+# Ключ подписи кодов билетов; без него выводится из токена бота, чтобы все воркеры считали одинаково
+TICKET_SIGNING_KEY = (os.getenv('TICKET_SIGNING_KEY') or f"tickets:{TOKEN}").encode()
+
 
 price_ranges = [
     (0, 0, "Бесплатно"),
@@ -50,89 +124,2003 @@ price_ranges = [
 
 
 class UserDatabase:
+    INDEXED_FIELDS = ('id', 'email', 'username')
+
     def __init__(self, filename='users.json'):
         self.filename = filename
+        self.journal_filename = os.path.splitext(filename)[0] + '.journal'
+        self._lock = threading.RLock()
+        self._journal = None
+        self._journal_records = 0
+        self._unsynced = 0
+        self._compacting = False
+        self._flusher = None
         self.data = self._load_data()
+        self._build_indexes()
+        atexit.register(self.close)
     
     def _load_data(self):
+        # Под блокировкой: хвост журнала может быть записью, которую другой воркер ещё дописывает
+        with file_lock(self.journal_filename):
+            self._truncate_torn_tail(self.journal_filename)
+            data, self._journal_records = self._read_disk()
+        return data
+
+    def _read_disk(self):
         try:
             with open(self.filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                data = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
-            return {'users': []}
+            data = {'users': []}
+
+        # Снапшот + журнал, который не успели сжать (если процесс упал посреди сжатия)
+        users = {u['id']: u for u in data['users']}
+        records = 0
+        for path in (self.journal_filename + '.compacting', self.journal_filename):
+            for record in self._read_journal(path):
+                self._apply_record(users, record)
+                if path == self.journal_filename:
+                    records += 1
+        data['users'] = list(users.values())
+        return data, records
+
+    @staticmethod
+    def _read_journal(path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная последняя запись после падения
+                    print(f"Пропущена повреждённая запись журнала {path}")
+                    return
+
+    @staticmethod
+    def _truncate_torn_tail(path):
+        # Оборванную после падения запись отрезаем, иначе новые записи допишутся
+        # в ту же строку и потеряются при следующем запуске
+        if not os.path.exists(path):
+            return
+        valid = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+            size = f.seek(0, os.SEEK_END)
+        if valid < size:
+            print(f"Журнал {path} обрезан до последней целой записи ({size - valid} байт отброшено)")
+            with open(path, 'r+b') as f:
+                f.truncate(valid)
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def _apply_record(users, record):
+        if record['op'] == 'add':
+            users[record['user']['id']] = record['user']
+        elif record['op'] == 'set' and record['id'] in users:
+            users[record['id']][record['key']] = record['value']
     
-    def _save_data(self):
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, indent=4, ensure_ascii=False)
+    def _journal_replaced(self):
+        # Другой воркер мог сжать журнал: наш дескриптор тогда смотрит на удалённый файл
+        try:
+            return os.stat(self.journal_filename).st_ino != os.fstat(self._journal.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _append(self, record):
+        with self._lock, file_lock(self.journal_filename):
+            if self._journal is not None and self._journal_replaced():
+                self._sync()
+                self._journal.close()
+                self._journal = None
+            if self._journal is None:
+                self._journal = open(self.journal_filename, 'a', encoding='utf-8')
+            self._journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._journal.flush()
+            self._journal_records += 1
+            self._unsynced += 1
+            if self._unsynced >= USER_JOURNAL_FSYNC_BATCH:
+                self._sync()
+            elif self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='users-journal', daemon=True)
+                self._flusher.start()
+            if self._journal_records >= USER_JOURNAL_COMPACT_AFTER and not self._compacting:
+                self._compacting = True
+                threading.Thread(target=self.compact, name='users-compact', daemon=True).start()
+
+    def _sync(self):
+        if self._journal is not None and self._unsynced:
+            os.fsync(self._journal.fileno())
+            self._unsynced = 0
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(USER_JOURNAL_FSYNC_INTERVAL)
+            with self._lock:
+                self._sync()
+
+    def compact(self):
+        compacting_path = self.journal_filename + '.compacting'
+        try:
+            # Журнал общий для всех воркеров: пока идёт сжатие, никто не дописывает,
+            # а снапшот собирается с диска, а не из памяти этого процесса
+            with self._lock, file_lock(self.journal_filename):
+                self._sync()
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                if os.path.exists(self.journal_filename):
+                    os.replace(self.journal_filename, compacting_path)
+                self._journal_records = 0
+                data, _ = self._read_disk()
+                write_json_atomic(self.filename, data)
+                if os.path.exists(compacting_path):
+                    os.remove(compacting_path)
+        except Exception as e:
+            print(f"Ошибка сжатия журнала пользователей: {e}")
+        finally:
+            self._compacting = False
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _build_indexes(self):
+        self._indexes = {field: {} for field in self.INDEXED_FIELDS}
+        for user in self.data['users']:
+            self._index_user(user)
+
+    def _index_user(self, user):
+        for field, index in self._indexes.items():
+            value = user.get(field)
+            if value is not None:
+                index.setdefault(value, user)
+
+    def get_user(self, user_id=None, email=None, username=None):
+        if user_id is not None:
+            return self._indexes['id'].get(user_id)
+        if email is not None:
+            return self._indexes['email'].get(email)
+        if username is not None:
+            return self._indexes['username'].get(username)
+        return None
 
     def user_exists(self, email=None, user_id=None):
-        for user in self.data['users']:
-            if user.get('email') == email or user.get('id') == user_id:
-                return True
-        return False
+        return (
+            (email is not None and email in self._indexes['email'])
+            or (user_id is not None and user_id in self._indexes['id'])
+        )
     
     def add_user(self, user_data):
-        self.data['users'].append(user_data)
-        self._save_data()
+        with self._lock:
+            self.data['users'].append(user_data)
+            self._index_user(user_data)
+            self._append({'op': 'add', 'user': user_data})
 
     def update_user(self, user_id, key, value):
-        for user in self.data['users']:
-            if user['id'] == user_id:
-                user[key] = value
-                self._save_data()
-                return True
-        return False
+        user = self.get_user(user_id=user_id)
+        if not user:
+            return False
+        with self._lock:
+            if key in self._indexes:
+                index = self._indexes[key]
+                old_value = user.get(key)
+                if index.get(old_value) is user:
+                    del index[old_value]
+                if value is not None:
+                    index[value] = user
+            user[key] = value
+            self._append({'op': 'set', 'id': user_id, 'key': key, 'value': value})
+        return True
     
     def toggle_notifications(self, user_id):
-        for user in self.data['users']:
-            if user['id'] == user_id:
-                current = user.get("notifications", True)
-                user["notifications"] = not current
-                self._save_data()
-                return user["notifications"]
+        user = self.get_user(user_id=user_id)
+        if not user:
+            return None
+        new_value = not user.get("notifications", True)
+        self.update_user(user_id, "notifications", new_value)
+        return new_value
+
+@contextmanager
+def file_lock(path):
+    # Блокировка между процессами gunicorn на время чтения-изменения-записи файла
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def write_json_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonListRepository:
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+
+    def all(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                return json.load(f).get(self.key, [])
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            print(f"Ошибка загрузки {self.filename}: {e}")
+            return []
+
+    def add_many(self, items):
+        # Подписи файла до и после записи: по ним кеш решает, можно ли дописать записи на месте
+        with file_lock(self.filename):
+            before = self.signature()
+            if os.path.exists(self.filename):
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            else:
+                data = {self.key: []}
+            data[self.key].extend(items)
+            write_json_atomic(self.filename, data)
+            return before, self.signature()
+
+    def add(self, item):
+        return self.add_many([item])
+
+    def since(self, seq):
+        # Записи только дописываются в конец файла под file_lock, поэтому номер записи
+        # одинаков для всех воркеров и годится как курсор дельты
+        items = self.all()
+        return items[seq:], len(items)
+
+    def page(self, limit, before=None, after=None):
+        # Курсор — порядковый номер записи (с 1), страница идёт от новых к старым
+        items = list(enumerate(self.all(), 1))
+        if after is not None:
+            newer = [p for p in items if p[0] > after]
+            chunk = newer[:limit][::-1]
+            has_newer = len(newer) > limit
+            has_older = bool(chunk) and chunk[-1][0] > 1
+        else:
+            older = [p for p in items if before is None or p[0] < before]
+            chunk = older[-limit:][::-1] if limit else []
+            has_older = len(older) > limit
+            has_newer = bool(chunk) and chunk[0][0] < len(items)
+        return chunk, has_older, has_newer
+
+    def update(self, key, value, changes):
+        with file_lock(self.filename):
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            item = next((i for i in data[self.key] if i.get(key) == value), None)
+            if item is None:
+                return False
+            item.update(changes)
+            write_json_atomic(self.filename, data)
+        return True
+
+    def signature(self):
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+
+class SqliteStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            email TEXT,
+            username TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_email ON users(email);
+        CREATE INDEX IF NOT EXISTS users_username ON users(username);
+
+        CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT UNIQUE NOT NULL,
+            title TEXT,
+            date TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_date ON events(date);
+        CREATE INDEX IF NOT EXISTS events_title ON events(title);
+
+        CREATE TABLE IF NOT EXISTS tickets (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            event_title TEXT,
+            datetime TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tickets_user_event ON tickets(user_id, event_title);
+
+        CREATE TABLE IF NOT EXISTS news (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            datetime TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS news_datetime ON news(datetime);
+
+        CREATE TABLE IF NOT EXISTS inventory (
+            event_id TEXT PRIMARY KEY,
+            sold INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS holds (
+            id TEXT PRIMARY KEY,
+            event_id TEXT NOT NULL,
+            user_id INTEGER,
+            qty INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS holds_event ON holds(event_id);
+        CREATE INDEX IF NOT EXISTS holds_expires ON holds(expires_at);
+
+        CREATE TABLE IF NOT EXISTS payments (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            event_id TEXT,
+            status TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS payments_user_status ON payments(user_id, status);
+        CREATE INDEX IF NOT EXISTS payments_status_expires ON payments(status, expires_at);
+        CREATE INDEX IF NOT EXISTS payments_event_status ON payments(event_id, status);
+
+        CREATE TABLE IF NOT EXISTS checkins (
+            code TEXT PRIMARY KEY,
+            checked_in_at TEXT NOT NULL,
+            gate TEXT
+        );
+
+        -- Счётчики изменений событий и билетов: по ним воркеры узнают, что кеш устарел.
+        -- Триггеры увеличивают счётчик в той же транзакции, что и запись
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS events_insert_version AFTER INSERT ON events BEGIN
+            INSERT INTO table_versions (name, version) VALUES ('events', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS events_update_version AFTER UPDATE ON events BEGIN
+            INSERT INTO table_versions (name, version) VALUES ('events', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS events_delete_version AFTER DELETE ON events BEGIN
+            INSERT INTO table_versions (name, version) VALUES ('events', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tickets_insert_version AFTER INSERT ON tickets BEGIN
+            INSERT INTO table_versions (name, version) VALUES ('tickets', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tickets_update_version AFTER UPDATE ON tickets BEGIN
+            INSERT INTO table_versions (name, version) VALUES ('tickets', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tickets_delete_version AFTER DELETE ON tickets BEGIN
+            INSERT INTO table_versions (name, version) VALUES ('tickets', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        END;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def table_version(self, table, conn=None):
+        sql, params = "SELECT version FROM table_versions WHERE name = ?", (table,)
+        rows = conn.execute(sql, params).fetchall() if conn else self.query(sql, params)
+        return rows[0]['version'] if rows else 0
+
+    def update_json(self, table, column, value, changes):
+        # column — имя колонки из схемы выше, не пользовательский ввод
+        with self.transaction() as conn:
+            row = conn.execute(f"SELECT seq, data FROM {table} WHERE {column} = ? LIMIT 1", (value,)).fetchone()
+            if not row:
+                return False
+            item = json.loads(row['data'])
+            item.update(changes)
+            conn.execute(f"UPDATE {table} SET data = ? WHERE seq = ?", (json.dumps(item, ensure_ascii=False), row['seq']))
+        return True
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+
+class SqliteUserDatabase:
+    def __init__(self, store):
+        self.store = store
+
+    def get_user(self, user_id=None, email=None, username=None):
+        if user_id is not None:
+            rows = self.store.query("SELECT data FROM users WHERE id = ?", (user_id,))
+        elif email is not None:
+            rows = self.store.query("SELECT data FROM users WHERE email = ? LIMIT 1", (email,))
+        elif username is not None:
+            rows = self.store.query("SELECT data FROM users WHERE username = ? LIMIT 1", (username,))
+        else:
+            return None
+        return json.loads(rows[0]['data']) if rows else None
+
+    def user_exists(self, email=None, user_id=None):
+        return (
+            (email is not None and self.get_user(email=email) is not None)
+            or (user_id is not None and self.get_user(user_id=user_id) is not None)
+        )
+
+    @staticmethod
+    def _write(conn, user):
+        conn.execute(
+            "INSERT OR REPLACE INTO users (id, email, username, data) VALUES (?, ?, ?, ?)",
+            (user['id'], user.get('email'), user.get('username'), json.dumps(user, ensure_ascii=False))
+        )
+
+    def add_user(self, user_data):
+        with self.store.transaction() as conn:
+            self._write(conn, user_data)
+
+    def update_user(self, user_id, key, value):
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+            if not row:
+                return False
+            user = json.loads(row['data'])
+            user[key] = value
+            self._write(conn, user)
+        return True
+
+    def toggle_notifications(self, user_id):
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+            if not row:
+                return None
+            user = json.loads(row['data'])
+            user["notifications"] = not user.get("notifications", True)
+            self._write(conn, user)
+        return user["notifications"]
+
+
+class SqliteEventRepository:
+    def __init__(self, store):
+        self.store = store
+
+    def all(self):
+        return [json.loads(r['data']) for r in self.store.query("SELECT data FROM events ORDER BY seq")]
+
+    def add_many(self, events):
+        with self.store.transaction() as conn:
+            before = self.store.table_version('events', conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO events (id, title, date, data) VALUES (?, ?, ?, ?)",
+                [(e['id'], e['title'], e['date'], json.dumps(e, ensure_ascii=False)) for e in events]
+            )
+            return before, self.store.table_version('events', conn)
+
+    def add(self, event):
+        return self.add_many([event])
+
+    def update(self, key, value, changes):
+        return self.store.update_json('events', key, value, changes)
+
+    def signature(self):
+        # Счётчик только этой таблицы: брони, оплаты и отметки прохода кеш не сбрасывают
+        return self.store.table_version('events')
+
+
+class SqliteTicketRepository:
+    def __init__(self, store):
+        self.store = store
+
+    def all(self):
+        return [json.loads(r['data']) for r in self.store.query("SELECT data FROM tickets ORDER BY seq")]
+
+    def add_many(self, orders):
+        with self.store.transaction() as conn:
+            before = self.store.table_version('tickets', conn)
+            conn.executemany(
+                "INSERT INTO tickets (user_id, event_title, datetime, data) VALUES (?, ?, ?, ?)",
+                [(o['user_id'], o['event_title'], o.get('datetime'), json.dumps(o, ensure_ascii=False)) for o in orders]
+            )
+            return before, self.store.table_version('tickets', conn)
+
+    def add(self, order):
+        return self.add_many([order])
+
+    def since(self, seq):
+        rows = self.store.query("SELECT seq, data FROM tickets WHERE seq > ? ORDER BY seq", (seq,))
+        return [json.loads(r['data']) for r in rows], (rows[-1]['seq'] if rows else seq)
+
+    def signature(self):
+        return self.store.table_version('tickets')
+
+
+class SqliteNewsRepository:
+    def __init__(self, store):
+        self.store = store
+
+    def all(self):
+        return [json.loads(r['data']) for r in self.store.query("SELECT data FROM news ORDER BY seq")]
+
+    def add_many(self, items):
+        with self.store.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO news (datetime, data) VALUES (?, ?)",
+                [(n.get('datetime'), json.dumps(n, ensure_ascii=False)) for n in items]
+            )
+
+    def add(self, news_item):
+        self.add_many([news_item])
+
+    def update(self, key, value, changes):
+        return self.store.update_json('news', key, value, changes)
+
+    def page(self, limit, before=None, after=None):
+        if after is not None:
+            rows = self.store.query("SELECT seq, data FROM news WHERE seq > ? ORDER BY seq LIMIT ?", (after, limit + 1))
+            has_newer = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_older = bool(rows) and bool(self.store.query("SELECT 1 FROM news WHERE seq < ? LIMIT 1", (rows[-1]['seq'],)))
+        else:
+            if before is None:
+                rows = self.store.query("SELECT seq, data FROM news ORDER BY seq DESC LIMIT ?", (limit + 1,))
+            else:
+                rows = self.store.query("SELECT seq, data FROM news WHERE seq < ? ORDER BY seq DESC LIMIT ?", (before, limit + 1))
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+            has_newer = bool(rows) and bool(self.store.query("SELECT 1 FROM news WHERE seq > ? LIMIT 1", (rows[0]['seq'],)))
+        return [(r['seq'], json.loads(r['data'])) for r in rows], has_older, has_newer
+
+
+class JsonCheckinLog:
+    # Журнал отметок о проходе: одна строка на билет, запись под flock,
+    # поэтому два воркера не пропустят один билет дважды
+    def __init__(self, filename='checkins.jsonl'):
+        self.filename = filename
+        self._offset = 0
+        self._checked = {}
+
+    def _catch_up(self, f):
+        f.seek(self._offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            record = json.loads(line)
+            self._checked.setdefault(record['code'], record)
+            self._offset += len(line)
+
+    def all(self):
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                self._catch_up(f)
+        return list(self._checked.values())
+
+    def get(self, code):
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                self._catch_up(f)
+        return self._checked.get(code)
+
+    def since(self, position):
+        # Позиция — число записей в журнале; по ней сканер забирает только новые отметки
+        records = self.all()
+        return records[position:], len(records)
+
+    def mark(self, records):
+        # records — пары (код, турникет, время прохода); время None — отметка сейчас.
+        # Вся пачка пишется одной дозаписью под одним flock
+        results = []
+        with open(self.filename, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._catch_up(f)
+                now = datetime.now().isoformat()
+                lines = []
+                for code, gate, checked_in_at in records:
+                    if code in self._checked:
+                        results.append((False, self._checked[code]))
+                        continue
+                    record = {'code': code, 'checked_in_at': checked_in_at or now, 'gate': gate}
+                    self._checked[code] = record
+                    results.append((True, record))
+                    lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+                if lines:
+                    data = ''.join(lines).encode('utf-8')
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._offset += len(data)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return results
+
+
+class SqliteCheckinRepository:
+    def __init__(self, store):
+        self.store = store
+
+    def all(self):
+        return [dict(r) for r in self.store.query("SELECT code, checked_in_at, gate FROM checkins")]
+
+    def get(self, code):
+        rows = self.store.query("SELECT code, checked_in_at, gate FROM checkins WHERE code = ?", (code,))
+        return dict(rows[0]) if rows else None
+
+    def since(self, position):
+        rows = self.store.query(
+            "SELECT rowid, code, checked_in_at, gate FROM checkins WHERE rowid > ? ORDER BY rowid", (position,)
+        )
+        records = [{'code': r['code'], 'checked_in_at': r['checked_in_at'], 'gate': r['gate']} for r in rows]
+        return records, (rows[-1]['rowid'] if rows else position)
+
+    def mark(self, records):
+        results = []
+        now = datetime.now().isoformat()
+        with self.store.transaction() as conn:
+            for code, gate, checked_in_at in records:
+                checked_in_at = checked_in_at or now
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO checkins (code, checked_in_at, gate) VALUES (?, ?, ?)",
+                    (code, checked_in_at, gate)
+                )
+                if cursor.rowcount:
+                    results.append((True, {'code': code, 'checked_in_at': checked_in_at, 'gate': gate}))
+                else:
+                    row = conn.execute("SELECT code, checked_in_at, gate FROM checkins WHERE code = ?", (code,)).fetchone()
+                    results.append((False, dict(row)))
+        return results
+
+
+class JsonReservationStore:
+    # Проданные места и временные брони в одном файле; всё меняется под file_lock,
+    # поэтому параллельные хендлеры и воркеры не продадут одно место дважды
+    def __init__(self, filename='reservations.json'):
+        self.filename = filename
+
+    @contextmanager
+    def _state(self):
+        with file_lock(self.filename):
+            try:
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {'sold': {}, 'holds': {}}
+            now = time.time()
+            for hold_id in [h for h, hold in data['holds'].items() if hold['expires_at'] <= now]:
+                del data['holds'][hold_id]
+            yield data
+            write_json_atomic(self.filename, data)
+
+    @staticmethod
+    def _sold(data, event_id, seed):
+        if event_id not in data['sold']:
+            data['sold'][event_id] = seed()
+        return data['sold'][event_id]
+
+    @staticmethod
+    def _held(data, event_id):
+        return sum(h['qty'] for h in data['holds'].values() if h['event_id'] == event_id)
+
+    def hold(self, event_id, user_id, qty, capacity, ttl, seed):
+        if qty <= 0:
+            raise ValueError(f"Некорректное количество мест для брони: {qty}")
+        with self._state() as data:
+            taken = self._sold(data, event_id, seed) + self._held(data, event_id)
+            if capacity is not None and taken + qty > capacity:
+                return None
+            hold_id = uuid.uuid4().hex
+            data['holds'][hold_id] = {
+                'event_id': event_id, 'user_id': user_id, 'qty': qty, 'expires_at': time.time() + ttl
+            }
+            return hold_id
+
+    def extend(self, hold_id, ttl):
+        with self._state() as data:
+            hold = data['holds'].get(hold_id)
+            if hold:
+                hold['expires_at'] = time.time() + ttl
+            return hold is not None
+
+    def commit(self, hold_id):
+        with self._state() as data:
+            hold = data['holds'].pop(hold_id, None)
+            if hold:
+                data['sold'][hold['event_id']] = data['sold'].get(hold['event_id'], 0) + hold['qty']
+            return hold is not None
+
+    def release(self, hold_id):
+        with self._state() as data:
+            return data['holds'].pop(hold_id, None) is not None
+
+    def taken(self, event_id, seed):
+        with self._state() as data:
+            return self._sold(data, event_id, seed) + self._held(data, event_id)
+
+
+class SqliteReservationStore:
+    def __init__(self, store):
+        self.store = store
+
+    @contextmanager
+    def _state(self):
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM holds WHERE expires_at <= ?", (time.time(),))
+            yield conn
+
+    @staticmethod
+    def _taken(conn, event_id, seed):
+        row = conn.execute("SELECT sold FROM inventory WHERE event_id = ?", (event_id,)).fetchone()
+        if row is None:
+            sold = seed()
+            conn.execute("INSERT INTO inventory (event_id, sold) VALUES (?, ?)", (event_id, sold))
+        else:
+            sold = row['sold']
+        held = conn.execute("SELECT COALESCE(SUM(qty), 0) FROM holds WHERE event_id = ?", (event_id,)).fetchone()[0]
+        return sold + held
+
+    def hold(self, event_id, user_id, qty, capacity, ttl, seed):
+        if qty <= 0:
+            raise ValueError(f"Некорректное количество мест для брони: {qty}")
+        with self._state() as conn:
+            if capacity is not None and self._taken(conn, event_id, seed) + qty > capacity:
+                return None
+            hold_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO holds (id, event_id, user_id, qty, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (hold_id, event_id, user_id, qty, time.time() + ttl)
+            )
+            return hold_id
+
+    def extend(self, hold_id, ttl):
+        with self._state() as conn:
+            return conn.execute("UPDATE holds SET expires_at = ? WHERE id = ?", (time.time() + ttl, hold_id)).rowcount > 0
+
+    def commit(self, hold_id):
+        with self._state() as conn:
+            row = conn.execute("SELECT event_id, qty FROM holds WHERE id = ?", (hold_id,)).fetchone()
+            if row is None:
+                return False
+            conn.execute("DELETE FROM holds WHERE id = ?", (hold_id,))
+            conn.execute(
+                "INSERT INTO inventory (event_id, sold) VALUES (?, ?) "
+                "ON CONFLICT(event_id) DO UPDATE SET sold = sold + excluded.sold",
+                (row['event_id'], row['qty'])
+            )
+            return True
+
+    def release(self, hold_id):
+        with self._state() as conn:
+            return conn.execute("DELETE FROM holds WHERE id = ?", (hold_id,)).rowcount > 0
+
+    def taken(self, event_id, seed):
+        with self._state() as conn:
+            return self._taken(conn, event_id, seed)
+
+
+class JsonPaymentStore:
+    # Заявки на оплату в payments.json. В памяти — индексы по id и по ожидающим заявкам
+    # пользователя; другой воркер меняет файл — индексы перечитываются по mtime/размеру
+    def __init__(self, filename='payments.json'):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._signature = None
+        self._loaded = False
+        self._by_id = {}
+        self._pending_by_user = {}
+        self._pending_by_event = {}
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                return json.load(f)['payments']
+        except FileNotFoundError:
+            return []
+
+    def _index(self, payments):
+        self._by_id = {p['id']: p for p in payments}
+        self._pending_by_user = {}
+        self._pending_by_event = {}
+        for p in payments:
+            if p['status'] == 'pending':
+                self._pending_by_user.setdefault(p['user_id'], {})[p['id']] = p
+                self._pending_by_event.setdefault(p.get('event_id'), {})[p['id']] = p
+
+    def _refresh(self):
+        signature = self._file_signature()
+        if self._loaded and signature == self._signature:
+            return
+        with self._lock:
+            self._index(self._read())
+            self._signature = signature
+            self._loaded = True
+
+    @contextmanager
+    def _writing(self):
+        with file_lock(self.filename):
+            payments = self._read()
+            yield payments
+            write_json_atomic(self.filename, {'payments': payments})
+            with self._lock:
+                self._index(payments)
+                self._signature = self._file_signature()
+                self._loaded = True
+
+    def add(self, payment):
+        with self._writing() as payments:
+            payments.append(payment)
+
+    def get(self, payment_id):
+        self._refresh()
+        return self._by_id.get(payment_id)
+
+    def pending_for_user(self, user_id):
+        self._refresh()
+        return list(self._pending_by_user.get(user_id, {}).values())
+
+    def pending_for_event(self, event_id):
+        self._refresh()
+        return list(self._pending_by_event.get(event_id, {}).values())
+
+    def transition(self, payment_ids, status, from_status='pending'):
+        # Меняет статус только у заявок в from_status: две параллельные /confirm
+        # не подтвердят одну заявку дважды
+        wanted = set(payment_ids)
+        changed = []
+        with self._writing() as payments:
+            for p in payments:
+                if p['id'] in wanted and p['status'] == from_status:
+                    p['status'] = status
+                    p['updated_at'] = time.time()
+                    changed.append(dict(p))
+        return changed
+
+    def due_for_expiry(self, now):
+        self._refresh()
+        return [p['id'] for by_user in self._pending_by_user.values() for p in by_user.values() if p['expires_at'] <= now]
+
+    def all(self):
+        return self._read()
+
+
+class SqlitePaymentStore:
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def _row(row):
+        return {**json.loads(row['data']), 'status': row['status']}
+
+    def add(self, payment):
+        with self.store.transaction() as conn:
+            conn.execute(
+                "INSERT INTO payments (id, user_id, event_id, status, expires_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (payment['id'], payment['user_id'], payment.get('event_id'), payment['status'],
+                 payment['expires_at'], json.dumps(payment, ensure_ascii=False))
+            )
+
+    def get(self, payment_id):
+        rows = self.store.query("SELECT status, data FROM payments WHERE id = ?", (payment_id,))
+        return self._row(rows[0]) if rows else None
+
+    def pending_for_user(self, user_id):
+        rows = self.store.query(
+            "SELECT status, data FROM payments WHERE user_id = ? AND status = 'pending'", (user_id,)
+        )
+        return [self._row(r) for r in rows]
+
+    def pending_for_event(self, event_id):
+        rows = self.store.query(
+            "SELECT status, data FROM payments WHERE event_id = ? AND status = 'pending'", (event_id,)
+        )
+        return [self._row(r) for r in rows]
+
+    def transition(self, payment_ids, status, from_status='pending'):
+        changed = []
+        with self.store.transaction() as conn:
+            for payment_id in payment_ids:
+                cursor = conn.execute(
+                    "UPDATE payments SET status = ? WHERE id = ? AND status = ?", (status, payment_id, from_status)
+                )
+                if cursor.rowcount:
+                    row = conn.execute("SELECT status, data FROM payments WHERE id = ?", (payment_id,)).fetchone()
+                    changed.append(self._row(row))
+        return changed
+
+    def due_for_expiry(self, now):
+        rows = self.store.query(
+            "SELECT id FROM payments WHERE status = 'pending' AND expires_at <= ?", (now,)
+        )
+        return [r['id'] for r in rows]
+
+
+class SqliteSessionStore(SqliteStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            version INTEGER NOT NULL,
+            last_active REAL NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB,
+            version INTEGER NOT NULL,
+            last_active REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, key)
+        );
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        # В базах, созданных до появления last_active, активность берём из версии (время записи)
+        with self.transaction() as conn:
+            for table in ('user_data', 'conversations'):
+                columns = [row['name'] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if 'last_active' not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN last_active REAL NOT NULL DEFAULT 0")
+                    conn.execute(f"UPDATE {table} SET last_active = version / 1e9")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_last_active ON {table} (last_active)")
+
+
+class SqlitePersistence(BasePersistence):
+    # user_data и состояния ConversationHandler в SQLite, по строке на пользователя.
+    # Application отдаёт изменения раз в update_interval, они копятся и пишутся одной транзакцией.
+    # Строки читаются лениво: перед апдейтом данные пользователя перечитываются,
+    # только если их версию поменял другой воркер
+    def __init__(self, path, update_interval=1.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = SqliteSessionStore(path)
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._flush_scheduled = False
+        self._user_versions = {}
+        self._conversation_versions = {}
+        self._conversation_handlers = None
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
         return None
 
-def load_news():
-    try:
-        with open("news.json", "r", encoding="utf-8") as f:
-            return json.load(f).get("news", [])
-    except:
-        return []
+    async def get_conversations(self, name):
+        return {}
 
-def save_news(news_item):
-    if not os.path.exists("news.json"):
-        with open("news.json", "w", encoding="utf-8") as f:
-            json.dump({"news": [news_item]}, f, indent=4, ensure_ascii=False)
-    else:
-        with open("news.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-        data["news"].append(news_item)
-        with open("news.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+    async def update_user_data(self, user_id, data):
+        self._pending_users[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, key)] = new_state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
 
-user_db = UserDatabase()
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._pending_users:
+            return
+        rows = self.store.query("SELECT version FROM user_data WHERE user_id = ?", (user_id,))
+        version = rows[0]['version'] if rows else None
+        if version == self._user_versions.get(user_id):
+            return
+        rows = self.store.query("SELECT data, version FROM user_data WHERE user_id = ?", (user_id,))
+        user_data.clear()
+        if rows:
+            user_data.update(pickle.loads(rows[0]['data']))
+            self._user_versions[user_id] = rows[0]['version']
+        else:
+            self._user_versions.pop(user_id, None)
+
+    async def refresh_conversations(self, application, update):
+        # ConversationHandler ищет состояние до refresh_user_data, поэтому состояния
+        # подтягиваются отдельно, до обработки апдейта. Хендлер не даёт публичного API
+        # для этого, приходится трогать _get_key и _conversations
+        if self._conversation_handlers is None:
+            self._conversation_handlers = [
+                handler for group in application.handlers.values() for handler in group
+                if isinstance(handler, ConversationHandler) and handler.persistent and handler.name
+            ]
+        for handler in self._conversation_handlers:
+            try:
+                key = handler._get_key(update)
+            except RuntimeError:
+                continue
+            if (handler.name, key) in self._pending_conversations:
+                continue
+            rows = self.store.query(
+                "SELECT state, version FROM conversations WHERE name = ? AND key = ?",
+                (handler.name, json.dumps(key))
+            )
+            version = rows[0]['version'] if rows else None
+            if version == self._conversation_versions.get((handler.name, key)):
+                continue
+            state = pickle.loads(rows[0]['state']) if rows and rows[0]['state'] is not None else None
+            if state is None or state == ConversationHandler.END:
+                handler._conversations.data.pop(key, None)
+            else:
+                handler._conversations.update_no_track({key: state})
+            self._conversation_versions[(handler.name, key)] = version
+
+    def _schedule_flush(self):
+        # Application вызывает update_* пачкой через gather; запись откладываем до конца пачки
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_pending)
+
+    def _flush_pending(self):
+        self._flush_scheduled = False
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not users and not conversations:
+            return
+        version = time.time_ns()
+        last_active = version / 1e9
+        try:
+            with self.store.transaction() as conn:
+                for user_id, data in users.items():
+                    if data is None:
+                        conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+                    else:
+                        conn.execute(
+                            "INSERT INTO user_data (user_id, data, version, last_active) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = excluded.version, "
+                            "last_active = excluded.last_active",
+                            (user_id, pickle.dumps(data), version, last_active)
+                        )
+                for (name, key), state in conversations.items():
+                    conn.execute(
+                        "INSERT INTO conversations (name, key, state, version, last_active) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state, version = excluded.version, "
+                        "last_active = excluded.last_active",
+                        (name, json.dumps(key), None if state is None else pickle.dumps(state), version, last_active)
+                    )
+        except Exception as e:
+            print(f"Ошибка записи состояния сессий: {e}")
+            for user_id, data in users.items():
+                self._pending_users.setdefault(user_id, data)
+            for key, state in conversations.items():
+                self._pending_conversations.setdefault(key, state)
+            return
+        for user_id, data in users.items():
+            if data is None:
+                self._user_versions.pop(user_id, None)
+            else:
+                self._user_versions[user_id] = version
+        for key in conversations:
+            self._conversation_versions[key] = version
+
+    def forget_users(self, user_ids):
+        # Память процесса освобождена без удаления строк: при следующем апдейте данные перечитаются из базы
+        for user_id in user_ids:
+            self._user_versions.pop(user_id, None)
+        for name, key in [k for k in self._conversation_versions if k[1] and k[1][-1] in user_ids]:
+            del self._conversation_versions[(name, key)]
+
+    def sweep_idle(self, user_idle, conversation_idle):
+        # Удаление общих строк решается по активности в базе, а не по таймерам отдельного воркера
+        now = time.time()
+        with self.store.transaction() as conn:
+            users = conn.execute(
+                "DELETE FROM user_data WHERE last_active < ?", (now - user_idle,)
+            ).rowcount
+            conversations = conn.execute(
+                "DELETE FROM conversations WHERE state IS NULL OR last_active < ?", (now - conversation_idle,)
+            ).rowcount
+        return users, conversations
+
+    async def flush(self):
+        self._flush_pending()
+
+
+def migrate_json_to_sqlite(store):
+    # Одноразовый перенос: таблицы должны быть пустыми, чтобы не задвоить билеты и новости
+    for table in ('users', 'events', 'tickets', 'news', 'checkins', 'payments'):
+        if store.query(f"SELECT 1 FROM {table} LIMIT 1"):
+            raise RuntimeError(f"Таблица {table} в {store.path} уже заполнена, миграция отменена")
+
+    users = UserDatabase().data['users']
+    events = JsonListRepository('events.json', 'events').all()
+    tickets = JsonListRepository('tickets.json', 'tickets').all()
+    news = JsonListRepository('news.json', 'news').all()
+    checkins = JsonCheckinLog().all()
+    payments = JsonPaymentStore().all()
+
+    user_repo = SqliteUserDatabase(store)
+    for user in users:
+        user_repo.add_user(user)
+    SqliteEventRepository(store).add_many(events)
+    SqliteTicketRepository(store).add_many(tickets)
+    SqliteNewsRepository(store).add_many(news)
+    SqliteCheckinRepository(store).mark([(r['code'], r.get('gate'), r['checked_in_at']) for r in checkins])
+    payment_repo = SqlitePaymentStore(store)
+    for payment in payments:
+        payment_repo.add(payment)
+    print(f"✅ Перенесено в {store.path}: пользователей {len(users)}, мероприятий {len(events)}, "
+          f"заказов {len(tickets)}, новостей {len(news)}, отметок о проходе {len(checkins)}, "
+          f"заявок на оплату {len(payments)}")
+
+
+if STORAGE_BACKEND == 'sqlite':
+    sqlite_store = SqliteStore(SQLITE_PATH)
+    user_db = SqliteUserDatabase(sqlite_store)
+    event_repo = SqliteEventRepository(sqlite_store)
+    ticket_repo = SqliteTicketRepository(sqlite_store)
+    news_repo = SqliteNewsRepository(sqlite_store)
+    checkin_repo = SqliteCheckinRepository(sqlite_store)
+    reservation_store = SqliteReservationStore(sqlite_store)
+    payment_store = SqlitePaymentStore(sqlite_store)
+else:
+    user_db = UserDatabase()
+    event_repo = JsonListRepository('events.json', 'events')
+    ticket_repo = JsonListRepository('tickets.json', 'tickets')
+    news_repo = JsonListRepository('news.json', 'news')
+    checkin_repo = JsonCheckinLog()
+    reservation_store = JsonReservationStore()
+    payment_store = JsonPaymentStore()
+
+def parse_price(price_str):
+    digits = re.findall(r"\d+", price_str or "")
+    return int(digits[0]) if digits else 0
+
+
+class Event:
+    # Дата и цена разбираются один раз при создании, исходные строки остаются для вывода
+    __slots__ = ('id', 'title', 'description', 'location', 'image',
+                 'date', 'date_text', 'price', 'price_text', 'extra')
+
+    FIELDS = ('id', 'title', 'description', 'date', 'location', 'image', 'price')
+
+    def __init__(self, id, title, description, date_text, location, image=None, price_text="Бесплатно", extra=None):
+        self.id = id
+        self.title = title
+        self.description = description
+        self.location = location
+        self.image = image
+        self.date_text = date_text
+        self.date = datetime.strptime(date_text, "%Y-%m-%d").date()
+        self.price_text = price_text
+        self.price = parse_price(price_text)
+        self.extra = extra or {}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            id=data['id'],
+            title=data['title'],
+            description=data.get('description', ''),
+            date_text=data['date'],
+            location=data.get('location', ''),
+            image=data.get('image'),
+            price_text=data.get('price', 'Бесплатно'),
+            extra={k: v for k, v in data.items() if k not in cls.FIELDS},
+        )
+
+    @property
+    def capacity(self):
+        # Вместимость хранится среди дополнительных полей; None — без ограничения
+        value = self.extra.get('capacity')
+        return int(value) if value is not None else None
+
+    @property
+    def waiting_room_rate(self):
+        # Сколько покупателей в минуту впускать к покупке; 0 — комната ожидания выключена
+        return int(self.extra.get('waiting_room_rate') or 0)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "description": self.description,
+            "date": self.date_text,
+            "location": self.location,
+            "image": self.image,
+            "price": self.price_text,
+            **self.extra,
+        }
+
+
+class EventCatalog:
+    def __init__(self, repo):
+        self.repo = repo
+        self._lock = threading.Lock()
+        self._signature = None
+        self._loaded = False
+        self._events = []
+        self._by_id = {}
+        self._by_title = {}
+        # Отсортированные индексы: ключи лежат отдельно, чтобы искать через bisect
+        self._dates = []
+        self._by_date = []
+        self._prices = []
+        self._by_price = []
+
+    def _refresh(self):
+        signature = self.repo.signature()
+        if self._loaded and signature == self._signature:
+            return
+        with self._lock:
+            events = []
+            for data in self.repo.all():
+                try:
+                    events.append(Event.from_dict(data))
+                except (KeyError, ValueError) as e:
+                    print(f"Пропущено мероприятие с некорректными данными {data.get('id')}: {e}")
+            self._by_id = {e.id: e for e in events}
+            self._by_title = {}
+            for e in events:
+                self._by_title.setdefault(e.title, e)
+            self._by_date = sorted(events, key=lambda e: e.date)
+            self._dates = [e.date for e in self._by_date]
+            self._by_price = sorted(events, key=lambda e: e.price)
+            self._prices = [e.price for e in self._by_price]
+            self._events = events
+            self._signature = signature
+            self._loaded = True
+
+    def invalidate(self):
+        self._loaded = False
+
+    def all(self):
+        self._refresh()
+        return self._events
+
+    def get(self, event_id):
+        self._refresh()
+        return self._by_id.get(event_id)
+
+    def get_by_title(self, title):
+        self._refresh()
+        return self._by_title.get(title)
+
+    def upcoming(self, today, min_price=None, max_price=None):
+        self._refresh()
+        if min_price is None or max_price is None:
+            return self._by_date[bisect.bisect_left(self._dates, today):]
+
+        # Берём только мероприятия из нужного диапазона цен, затем отсекаем прошедшие
+        lo = bisect.bisect_left(self._prices, min_price)
+        hi = bisect.bisect_right(self._prices, max_price)
+        matching = [e for e in self._by_price[lo:hi] if e.date >= today]
+        matching.sort(key=lambda e: e.date)
+        return matching
+
+    def upcoming_page(self, today, offset, limit, min_price=None, max_price=None):
+        self._refresh()
+        if min_price is None or max_price is None:
+            start = bisect.bisect_left(self._dates, today)
+            total = len(self._by_date) - start
+            return self._by_date[start + offset:start + offset + limit], total
+        matching = self.upcoming(today, min_price, max_price)
+        return matching[offset:offset + limit], len(matching)
+
+    # После правки каталог перечитывается: между _refresh() и записью файл мог поменять
+    # другой воркер, и подпись после записи скрыла бы его изменения навсегда
+    def update_extra(self, event_id, changes):
+        try:
+            self.repo.update('id', event_id, changes)
+        finally:
+            self.invalidate()
 
-def load_events(filename='events.json'):
+    def add(self, event):
+        # Новое мероприятие встаёт в индексы на место, если до записи хранилище было тем,
+        # что уже загружено; иначе его успел поменять другой воркер и каталог перечитывается
+        try:
+            before, after = self.repo.add(event.to_dict())
+        except Exception:
+            self.invalidate()
+            raise
+        with self._lock:
+            if not self._loaded or before != self._signature or event.id in self._by_id:
+                self._loaded = False
+                return
+            self._events.append(event)
+            self._by_id[event.id] = event
+            self._by_title.setdefault(event.title, event)
+            i = bisect.bisect_right(self._dates, event.date)
+            self._dates.insert(i, event.date)
+            self._by_date.insert(i, event)
+            i = bisect.bisect_right(self._prices, event.price)
+            self._prices.insert(i, event.price)
+            self._by_price.insert(i, event)
+            self._signature = after
+
+event_catalog = EventCatalog(event_repo)
+
+def save_news(news_item):
+    news_repo.add(news_item)
+
+def save_event(event):
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get('events', [])
+        event_catalog.add(event)
     except Exception as e:
-        print(f"Ошибка загрузки мероприятий: {e}")
-        return []
+        print(f"Ошибка сохранения мероприятия: {e}")
+
+class TicketIndex:
+    def __init__(self, repo):
+        self.repo = repo
+        self._lock = threading.Lock()
+        self._signature = None
+        self._loaded = False
+        self._orders = []
+        self._by_user = {}
+        self._by_user_event = {}
+        self._by_code = {}
+
+    def _refresh(self):
+        signature = self.repo.signature()
+        if self._loaded and signature == self._signature:
+            return
+        with self._lock:
+            self._orders = []
+            self._by_user = {}
+            self._by_user_event = {}
+            self._by_code = {}
+            for order in self.repo.all():
+                self._index_order(order)
+            self._signature = signature
+            self._loaded = True
+
+    def _index_order(self, order):
+        self._orders.append(order)
+        self._by_user.setdefault(order['user_id'], []).append(order)
+        self._by_user_event.setdefault((order['user_id'], order['event_title']), []).append(order)
+        for seat, code in enumerate(order.get('codes', [])):
+            self._by_code[code] = (order, seat)
+
+    def invalidate(self):
+        self._loaded = False
+
+    def all(self):
+        self._refresh()
+        return self._orders
+
+    def orders_for_user(self, user_id):
+        self._refresh()
+        return self._by_user.get(user_id, [])
+
+    def orders_for(self, user_id, event_title):
+        self._refresh()
+        return self._by_user_event.get((user_id, event_title), [])
+
+    def find_code(self, code):
+        self._refresh()
+        return self._by_code.get(code)
+
+    def sold_count(self, event_title):
+        self._refresh()
+        return sum(len(o.get('codes') or []) or o.get('qty', 0) for o in self._orders if o['event_title'] == event_title)
+
+    def orders_since(self, seq):
+        # Курсор берём из хранилища (seq в SQLite, номер записи в файле), а не из
+        # локального списка: порядок в памяти у воркеров может отличаться
+        return self.repo.since(seq)
+
+    def event_titles_for_user(self, user_id):
+        return {order['event_title'] for order in self.orders_for_user(user_id)}
+
+    def add_many(self, orders):
+        # Как и в EventCatalog: заказы дописываются в индекс, только если до записи
+        # хранилище совпадало с загруженным, иначе индекс перечитывается целиком
+        try:
+            before, after = self.repo.add_many(orders)
+        except Exception:
+            self.invalidate()
+            raise
+        with self._lock:
+            if not self._loaded or before != self._signature:
+                self._loaded = False
+                return
+            for order in orders:
+                self._index_order(order)
+            self._signature = after
+
+ticket_index = TicketIndex(ticket_repo)
+
+class CheckinService:
+    def __init__(self, tickets, log):
+        self.tickets = tickets
+        self.log = log
+
+    def _find(self, code):
+        # Поддельный код нового формата отбрасываем по подписи, не трогая индекс
+        if parse_ticket_code(code) is False:
+            return 'invalid'
+        return self.tickets.find_code(code) or 'not_found'
+
+    def check_in(self, codes, gate=None):
+        found = [self._find(code) for code in codes]
+        valid = [code for code, hit in zip(codes, found) if not isinstance(hit, str)]
+        marked = iter(self.log.mark([(code, gate, None) for code in valid]) if valid else [])
+
+        results = []
+        for code, hit in zip(codes, found):
+            if isinstance(hit, str):
+                results.append({'code': code, 'status': hit})
+                continue
+            order, seat = hit
+            is_new, record = next(marked)
+            results.append({
+                'code': code,
+                'status': 'ok' if is_new else 'already_checked_in',
+                'event_title': order['event_title'],
+                'user_id': order['user_id'],
+                'seat': seat + 1,
+                'checked_in_at': record['checked_in_at'],
+                'gate': record.get('gate'),
+            })
+        return results
+
+    def merge(self, records):
+        # Отметки, сделанные сканером без связи: время прохода берём из записи сканера,
+        # повторный проход одного билета возвращаем как конфликт
+        summary = {'imported': 0, 'duplicates': 0, 'not_found': 0, 'conflicts': []}
+        known = []
+        for record in records:
+            if isinstance(self._find(record['code']), str):
+                summary['not_found'] += 1
+            else:
+                known.append(record)
+        # Весь импорт — одна запись в журнал (одна транзакция), а не flock и fsync на каждую отметку
+        marked = self.log.mark([(r['code'], r.get('gate'), r.get('checked_in_at')) for r in known]) if known else []
+        for record, (is_new, stored) in zip(known, marked):
+            code = record['code']
+            if is_new:
+                summary['imported'] += 1
+            elif stored.get('checked_in_at') == record.get('checked_in_at') and stored.get('gate') == record.get('gate'):
+                summary['duplicates'] += 1
+            else:
+                summary['conflicts'].append({'code': code, 'stored': stored, 'offline': record})
+        return summary
+
+    def snapshot(self, event_title, tickets_since=0, checkins_since=0):
+        # Снимок для сканера: отсортированные 8-байтовые префиксы sha256 кодов билетов
+        # и уже отмеченных кодов; проверка на входе — бинарный поиск без сети.
+        # С ненулевыми tickets_since/checkins_since отдаётся только дельта
+        orders, tickets_version = self.tickets.orders_since(tickets_since)
+        records, checkins_version = self.log.since(checkins_since)
+
+        tickets = sorted(
+            ticket_code_hash(code)
+            for order in orders if order['event_title'] == event_title
+            for code in order.get('codes', [])
+        )
+        checked_in = []
+        for record in records:
+            hit = self.tickets.find_code(record['code'])
+            if hit and hit[0]['event_title'] == event_title:
+                checked_in.append(ticket_code_hash(record['code']))
+        checked_in.sort()
+
+        return {
+            'event_title': event_title,
+            'format': 'sha256-64',
+            'generated_at': datetime.now().isoformat(),
+            'delta': bool(tickets_since or checkins_since),
+            'base': {'tickets_version': tickets_since, 'checkins_version': checkins_since},
+            'tickets_version': tickets_version,
+            'checkins_version': checkins_version,
+            'tickets_count': len(tickets),
+            'tickets': base64.b64encode(b''.join(tickets)).decode(),
+            'checked_in_count': len(checked_in),
+            'checked_in': base64.b64encode(b''.join(checked_in)).decode(),
+        }
+
+def ticket_code_hash(code):
+    return hashlib.sha256(code.encode()).digest()[:8]
+
+checkin_service = CheckinService(ticket_index, checkin_repo)
+
+
+class ReservationService:
+    def __init__(self, store, tickets):
+        self.store = store
+        self.tickets = tickets
+
+    def _seed(self, event):
+        # Первое обращение к мероприятию: проданное считаем по уже выданным билетам
+        return lambda: self.tickets.sold_count(event.title)
+
+    def hold(self, event, user_id, qty, ttl=RESERVATION_TTL):
+        return self.store.hold(event.id, user_id, qty, event.capacity, ttl, self._seed(event))
+
+    def available(self, event):
+        if event.capacity is None:
+            return None
+        return max(event.capacity - self.store.taken(event.id, self._seed(event)), 0)
+
+    def extend(self, hold_id, ttl):
+        return self.store.extend(hold_id, ttl)
+
+    def release(self, hold_id):
+        return self.store.release(hold_id)
+
+    def commit(self, hold_id, event, user_id, qty):
+        # Бронь могла истечь, пока шла оплата: тогда пробуем занять места заново
+        if hold_id and self.store.commit(hold_id):
+            return True
+        hold_id = self.hold(event, user_id, qty)
+        return bool(hold_id) and self.store.commit(hold_id)
+
+reservations = ReservationService(reservation_store, ticket_index)
+
+
+class WaitingRoom:
+    # Очередь на покупку билетов популярного мероприятия: покупатели впускаются
+    # с заданной скоростью строго по порядку прихода, остальные видят своё место,
+    # а когда очередь заполнена, новых просят зайти позже, не трогая тех, кто уже ждёт
+    def __init__(self, event_id, rate):
+        self.event_id = event_id
+        self.rate = rate
+        self.queue = OrderedDict()
+        self.admitted = {}
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.task = None
+        self.bot = None
+        self.shed = 0
+        self.admitted_total = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        # Копим не больше одного тика впуска, чтобы после затишья не пустить толпу разом
+        burst = max(1.0, self.rate / 60 * WAITING_ROOM_TICK)
+        self.tokens = min(burst, self.tokens + (now - self.last_refill) * self.rate / 60)
+        self.last_refill = now
+        for user_id in [u for u, expires in self.admitted.items() if expires <= now]:
+            del self.admitted[user_id]
+
+    def _admit(self, user_id):
+        self.tokens -= 1
+        self.admitted[user_id] = time.monotonic() + WAITING_ROOM_ADMIT_TTL
+        self.admitted_total += 1
+
+    def _position_text(self, position):
+        minutes = max(1, round(position / self.rate))
+        return (f"⏳ Очень много желающих купить билеты.\n"
+                f"Ваше место в очереди: {position}. Примерное ожидание: ~{minutes} мин.\n"
+                f"Это сообщение обновляется само, не уходите.")
+
+    def _leave_keyboard(self):
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🚪 Выйти из очереди", callback_data=f"waiting_leave_{self.event_id}")]])
+
+    async def enter(self, user_id, chat, bot):
+        self._refill()
+        self.bot = bot
+        if user_id in self.admitted:
+            return True
+        if not self.queue and self.tokens >= 1:
+            self._admit(user_id)
+            return True
+
+        if user_id not in self.queue:
+            if len(self.queue) >= WAITING_ROOM_MAX:
+                self.shed += 1
+                await chat.send_message("😔 Сейчас очередь за билетами заполнена. Попробуйте через несколько минут.")
+                return False
+            msg = await chat.send_message(self._position_text(len(self.queue) + 1), reply_markup=self._leave_keyboard())
+            self.queue[user_id] = {'chat_id': chat.id, 'message_id': msg.message_id,
+                                   'position': len(self.queue) + 1, 'edited_at': time.monotonic()}
+        self._ensure_running()
+        return False
+
+    def leave(self, user_id):
+        return self.queue.pop(user_id, None)
+
+    def _ensure_running(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _edit(self, entry, text, reply_markup=None, attempts=3):
+        # Ошибка одного пользователя (заблокировал бота, сеть) не должна останавливать очередь;
+        # при RetryAfter сообщение отправляется повторно, чтобы впущенный узнал о своей очереди
+        for _ in range(attempts):
+            try:
+                await self.bot.edit_message_text(chat_id=entry['chat_id'], message_id=entry['message_id'],
+                                                 text=text, reply_markup=reply_markup)
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramError as e:
+                print(f"Не удалось обновить сообщение очереди: {e}")
+                return False
+        return False
+
+    async def _run(self):
+        while self.queue:
+            await asyncio.sleep(WAITING_ROOM_TICK)
+            self._refill()
+
+            while self.queue and self.tokens >= 1:
+                user_id, entry = self.queue.popitem(last=False)
+                self._admit(user_id)
+                await self._edit(entry, "🎉 Ваша очередь! У вас есть "
+                                 f"{WAITING_ROOM_ADMIT_TTL // 60} мин., чтобы оформить билеты.",
+                                 InlineKeyboardMarkup([[InlineKeyboardButton(
+                                     "🎟 Купить билеты", callback_data=f"waiting_buy_{self.event_id}")]]))
+
+            # Обновляем «ваше место» не чаще раза в интервал и ограниченной пачкой за тик
+            now = time.monotonic()
+            edits = 0
+            for position, entry in enumerate(list(self.queue.values()), 1):
+                if edits >= WAITING_ROOM_EDITS_PER_TICK:
+                    break
+                if entry['position'] != position and now - entry['edited_at'] >= WAITING_ROOM_UPDATE_INTERVAL:
+                    entry['position'] = position
+                    entry['edited_at'] = now
+                    edits += 1
+                    await self._edit(entry, self._position_text(position), self._leave_keyboard(), attempts=1)
+
+    def stats(self):
+        # Только чтение: просроченные допуски вычищает _refill в цикле впуска
+        now = time.monotonic()
+        admitted_active = sum(1 for expires in self.admitted.values() if expires > now)
+        return {"rate_per_minute": self.rate, "queued": len(self.queue), "admitted_active": admitted_active,
+                "admitted_total": self.admitted_total, "shed": self.shed}
+
+waiting_rooms = {}
+
+def get_waiting_room(event):
+    if not event.waiting_room_rate:
+        return None
+    room = waiting_rooms.get(event.id)
+    if room is None:
+        room = waiting_rooms[event.id] = WaitingRoom(event.id, event.waiting_room_rate)
+    room.rate = event.waiting_room_rate
+    return room
+
+def save_tickets(orders):
+    ticket_index.add_many(orders)
+
+def image_signature(path):
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+async def send_image(chat, path, cached, **kwargs):
+    # Повторно отправляем по file_id, пока сам файл картинки не менялся
+    signature = image_signature(path)
+    file_id = cached.get('image_file_id')
+    if file_id and cached.get('image_signature') == signature:
+        try:
+            return await chat.send_photo(photo=file_id, **kwargs), None
+        except BadRequest as e:
+            print(f"file_id {file_id} не принят, загружаем заново: {e}")
+
+    with open(path, "rb") as img:
+        msg = await chat.send_photo(photo=img, **kwargs)
+    return msg, {'image_file_id': msg.photo[-1].file_id, 'image_signature': signature}
+
+async def send_image_group(chat, items):
+    signatures = [image_signature(item['image']) for item in items]
+    cached_ids = [
+        item['cache'].get('image_file_id') if item['cache'].get('image_signature') == sig else None
+        for item, sig in zip(items, signatures)
+    ]
+
+    async def send(use_cache):
+        with ExitStack() as stack:
+            media = [
+                InputMediaPhoto(
+                    media=file_id if use_cache and file_id else stack.enter_context(open(item['image'], "rb")),
+                    caption=item['text'],
+                    parse_mode=item.get('parse_mode'),
+                )
+                for item, file_id in zip(items, cached_ids)
+            ]
+            return await chat.send_media_group(media=media)
 
-def save_event(event, filename='events.json'):
     try:
-        if os.path.exists(filename):
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+        messages = await send(use_cache=True)
+    except BadRequest as e:
+        if not any(cached_ids):
+            raise
+        print(f"Альбом с кэшированными file_id не принят, загружаем заново: {e}")
+        cached_ids = [None] * len(items)
+        messages = await send(use_cache=False)
+
+    return [
+        (msg, None if file_id else {'image_file_id': msg.photo[-1].file_id, 'image_signature': sig})
+        for msg, file_id, sig in zip(messages, cached_ids, signatures)
+    ]
+
+async def send_feed(chat, items):
+    # items: text, image (путь или None), cache, parse_mode, reply_markup, on_upload
+    # Возвращает [(item, message, grouped)]; у сообщений альбома нет своих кнопок
+    sent = []
+    i = 0
+    while i < len(items):
+        run = []
+        if FEED_MEDIA_GROUPS:
+            while i + len(run) < len(items) and len(run) < MEDIA_GROUP_LIMIT and items[i + len(run)]['image']:
+                run.append(items[i + len(run)])
+
+        if len(run) > 1:
+            for item, (msg, fresh) in zip(run, await send_image_group(chat, run)):
+                if fresh:
+                    item['on_upload'](fresh)
+                sent.append((item, msg, True))
+            i += len(run)
+            continue
+
+        item = items[i]
+        if item['image']:
+            msg, fresh = await send_image(
+                chat, item['image'], item['cache'],
+                caption=item['text'], parse_mode=item.get('parse_mode'), reply_markup=item.get('reply_markup'),
+            )
+            if fresh:
+                item['on_upload'](fresh)
         else:
-            data = {'events': []}
-        data['events'].append(event)
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        print(f"Ошибка сохранения мероприятия: {e}")
+            msg = await chat.send_message(text=item['text'], parse_mode=item.get('parse_mode'), reply_markup=item.get('reply_markup'))
+        sent.append((item, msg, False))
+        i += 1
+    return sent
+
+# Код билета: версия, мероприятие, заказ, место и обрезанный HMAC-SHA256 в base32.
+# Подлинность проверяется без обращения к хранилищу, а base32 кодируется
+# в QR алфавитно-цифровым режимом, поэтому QR меньше, чем у старых кодов
+TICKET_CODE_VERSION = 1
+TICKET_CODE_FORMAT = '>B16s8sH'
+TICKET_CODE_PAYLOAD = struct.calcsize(TICKET_CODE_FORMAT)
+# 27 байт данных + 8 байт подписи = 35 байт, ровно 56 символов base32 без "="
+TICKET_CODE_SIGNATURE = 8
+TICKET_CODE_PATTERN = re.compile(r'[A-Z2-7]{56}')
+
+def event_code_key(event_id):
+    try:
+        return uuid.UUID(str(event_id)).bytes
+    except ValueError:
+        return hashlib.sha256(str(event_id).encode()).digest()[:16]
+
+def new_order_id():
+    return os.urandom(8).hex()
+
+def make_ticket_code(event_id, order_id, seat):
+    payload = struct.pack(TICKET_CODE_FORMAT, TICKET_CODE_VERSION, event_code_key(event_id), bytes.fromhex(order_id), seat)
+    signature = hmac.new(TICKET_SIGNING_KEY, payload, hashlib.sha256).digest()[:TICKET_CODE_SIGNATURE]
+    return base64.b32encode(payload + signature).decode()
+
+def parse_ticket_code(code):
+    # None — код не в новом формате (например, старый), False — подпись не сошлась
+    if not TICKET_CODE_PATTERN.fullmatch(code):
+        return None
+    raw = base64.b32decode(code)
+    payload, signature = raw[:TICKET_CODE_PAYLOAD], raw[TICKET_CODE_PAYLOAD:]
+    if payload[0] != TICKET_CODE_VERSION:
+        return None
+    expected = hmac.new(TICKET_SIGNING_KEY, payload, hashlib.sha256).digest()[:TICKET_CODE_SIGNATURE]
+    if not hmac.compare_digest(signature, expected):
+        return False
+    _, event_key, order_id, seat = struct.unpack(TICKET_CODE_FORMAT, payload)
+    return SimpleNamespace(event_key=event_key, order_id=order_id.hex(), seat=seat)
+
+def render_qr_png(code):
+    buffer = BytesIO()
+    qrcode.make(code).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class LruBytesCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._items[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_qr_executor = None
+qr_cache = LruBytesCache(QR_CACHE_BYTES)
+qr_render_stats = {
+    'orders': 0, 'tickets': 0, 'total_seconds': 0.0, 'last_seconds': 0.0, 'max_seconds': 0.0,
+    'cache_hits': 0, 'cache_misses': 0,
+}
+
+def get_qr_executor():
+    global _qr_executor
+    if _qr_executor is None:
+        if QR_EXECUTOR == 'thread':
+            _qr_executor = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix='qr')
+        else:
+            # fork из процесса с уже запущенными потоками (loop, Flask, журнал) может зависнуть
+            # на унаследованной блокировке, поэтому процессы стартуют через forkserver
+            _qr_executor = ProcessPoolExecutor(max_workers=QR_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+    return _qr_executor
+
+async def render_ticket_qrs(codes):
+    # PNG — чистая функция кода билета, поэтому файлы не пишем, а кэшируем байты
+    images = [qr_cache.get(code) for code in codes]
+    missing = [i for i, png in enumerate(images) if png is None]
+    qr_render_stats['cache_hits'] += len(codes) - len(missing)
+    qr_render_stats['cache_misses'] += len(missing)
+    if not missing:
+        return images
+
+    loop = asyncio.get_running_loop()
+    executor = get_qr_executor()
+    started = time.perf_counter()
+    rendered = await asyncio.gather(*(
+        loop.run_in_executor(executor, render_qr_png, codes[i]) for i in missing
+    ))
+    elapsed = time.perf_counter() - started
+
+    for i, png in zip(missing, rendered):
+        images[i] = png
+        qr_cache.put(codes[i], png)
+
+    qr_render_stats['orders'] += 1
+    qr_render_stats['tickets'] += len(missing)
+    qr_render_stats['total_seconds'] += elapsed
+    qr_render_stats['last_seconds'] = elapsed
+    qr_render_stats['max_seconds'] = max(qr_render_stats['max_seconds'], elapsed)
+    return images
+
+def compose_ticket_sheet(images, first_number):
+    columns = min(TICKET_SHEET_COLUMNS, len(images))
+    rows = -(-len(images) // columns)
+    cell = TICKET_SHEET_CELL
+    label_height = 40
+    sheet = Image.new("RGB", (columns * cell, rows * (cell + label_height)), "white")
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default(size=24)
+
+    for i, png in enumerate(images):
+        x = (i % columns) * cell
+        y = (i // columns) * (cell + label_height)
+        qr = Image.open(BytesIO(png)).convert("RGB").resize((cell, cell), Image.NEAREST)
+        sheet.paste(qr, (x, y))
+        # Встроенный шрифт Pillow без кириллицы, поэтому только номер
+        draw.text((x + cell // 2, y + cell + label_height // 2), f"#{first_number + i}",
+                  fill="black", font=font, anchor="mm")
+
+    buffer = BytesIO()
+    sheet.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+class RateLimiter:
+    # Равномерно растягивает отправки: не больше rate сообщений в секунду на всех корутинах
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._lock = asyncio.Lock()
+        self._next = 0.0
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def deliver_tickets(bot, chat_id, images, label="🎫", limiter=None):
+    # Возвращает отправленные сообщения, чтобы вызывающий мог их потом удалить
+    async def throttle():
+        if limiter:
+            await limiter.wait()
+
+    messages = []
+    if TICKET_DELIVERY == 'sheet' and len(images) > 1:
+        per_sheet = TICKET_SHEET_COLUMNS * TICKET_SHEET_ROWS
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(images), per_sheet):
+            chunk = images[start:start + per_sheet]
+            sheet = await loop.run_in_executor(get_qr_executor(), compose_ticket_sheet, chunk, start + 1)
+            await throttle()
+            messages.append(await bot.send_photo(
+                chat_id=chat_id, photo=sheet,
+                caption=f"{label} Билеты #{start + 1}–{start + len(chunk)}"
+            ))
+    elif TICKET_DELIVERY == 'album' and len(images) > 1:
+        for start in range(0, len(images), MEDIA_GROUP_LIMIT):
+            chunk = images[start:start + MEDIA_GROUP_LIMIT]
+            await throttle()
+            if len(chunk) == 1:
+                messages.append(await bot.send_photo(chat_id=chat_id, photo=chunk[0], caption=f"{label} Билет #{start + 1}"))
+                continue
+            media = [
+                InputMediaPhoto(media=png, caption=f"{label} Билет #{start + i + 1}")
+                for i, png in enumerate(chunk)
+            ]
+            messages.extend(await bot.send_media_group(chat_id=chat_id, media=media))
+    else:
+        for i, png in enumerate(images):
+            await throttle()
+            messages.append(await bot.send_photo(chat_id=chat_id, photo=png, caption=f"{label} Билет #{i+1}"))
+    return messages
 
 
 async def delete_previous_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -147,6 +2135,13 @@ async def delete_previous_messages(update: Update, context: ContextTypes.DEFAULT
                 print(f"Ошибка при удалении сообщения {msg_id}: {e}")
         context.user_data['messages_to_delete'] = []
 
+def run_later(context, update, delay, callback):
+    # Пауза перед возвратом в меню идёт отдельной задачей и не держит воркер обработки апдейтов
+    async def later():
+        await asyncio.sleep(delay)
+        await callback()
+    context.application.create_task(later(), update=update)
+
 def get_price_filter_keyboard():
     keyboard = [[InlineKeyboardButton(label, callback_data=f"filter_{min}_{max}")]
                 for min, max, label in price_ranges]
@@ -207,66 +2202,253 @@ async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.edit_message_text("📝 Введите ваше ФИО:")
     return FULLNAME
 
+async def fulfil_payments(bot, payments):
+    # Выдаёт билеты по подтверждённым заявкам; заявки без свободных мест помечаются expired.
+    # Заказы сохраняются одной записью до отправки, так что билет не теряется, даже если доставка упала:
+    # покупатель увидит его в «Мои билеты»
+    orders, sold_out = [], []
+    for payment in payments:
+        event_id = payment.get('event_id')
+        event = event_catalog.get(event_id) if event_id else event_catalog.get_by_title(payment['event_title'])
+        if event_id is None:
+            event_id = event.id if event else payment['event_title']
+        if event and not reservations.commit(payment.get('hold_id'), event, payment['user_id'], payment['qty']):
+            sold_out.append(payment)
+            continue
+
+        order_id = new_order_id()
+        orders.append({
+            "order_id": order_id,
+            "payment_id": payment['id'],
+            "event_id": event_id,
+            "user_id": payment['user_id'],
+            "event_title": payment['event_title'],
+            "qty": payment['qty'],
+            "total": payment['total'],
+            "codes": [make_ticket_code(event_id, order_id, i) for i in range(payment['qty'])],
+            "datetime": datetime.now().isoformat(),
+        })
+
+    if orders:
+        save_tickets(orders)
+    if sold_out:
+        payment_store.transition([p['id'] for p in sold_out], 'expired', from_status='confirmed')
+
+    # Разные покупатели обслуживаются параллельно, заказы одного — по очереди,
+    # чтобы не упереться в лимит Telegram на сообщения в один чат
+    by_user = {}
+    for order in orders:
+        by_user.setdefault(order['user_id'], []).append(order)
+    limiter = RateLimiter(DELIVERY_RATE)
+    semaphore = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+
+    async def deliver(user_orders):
+        async with semaphore:
+            try:
+                for order in user_orders:
+                    qr_images = await render_ticket_qrs(order['codes'])
+                    await deliver_tickets(bot, order['user_id'], qr_images, limiter=limiter)
+            except Exception as e:
+                print(f"Ошибка отправки билетов пользователю {user_orders[0]['user_id']}: {e}")
+                return str(e)
+            return None
+
+    errors = await asyncio.gather(*(deliver(user_orders) for user_orders in by_user.values()))
+    failed = {user_id: error for user_id, error in zip(by_user, errors) if error}
+    return orders, sold_out, failed
+
+async def expire_pending_payments(bot):
+    expired = payment_store.transition(payment_store.due_for_expiry(time.time()), 'expired')
+    for payment in expired:
+        if payment.get('hold_id'):
+            reservations.release(payment['hold_id'])
+        try:
+            await bot.send_message(
+                chat_id=payment['user_id'],
+                text=f"⌛ Заявка на {payment['qty']} билет(ов) на «{payment['event_title']}» не была оплачена и отменена."
+            )
+        except Exception as e:
+            print(f"Не удалось уведомить об отмене заявки {payment['id']}: {e}")
+    return expired
+
+async def payment_expiry_loop(bot):
+    # Фоновая очистка брошенных заявок; переход статуса атомарный, поэтому несколько воркеров не мешают друг другу
+    while True:
+        await asyncio.sleep(PAYMENT_SWEEP_INTERVAL)
+        try:
+            expired = await expire_pending_payments(bot)
+            if expired:
+                print(f"Отменено неоплаченных заявок: {len(expired)}")
+        except Exception as e:
+            print(f"Ошибка при отмене неоплаченных заявок: {e}")
+
 async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    admin_data = next((u for u in user_db.data['users'] if u['id'] == user.id), None)
+    admin_data = user_db.get_user(user_id=user.id)
     if not admin_data or not admin_data.get("is_admin"):
         await update.message.reply_text("🚫 Только администратор может подтверждать оплату.")
         return
 
-    if not context.args or not context.args[0].startswith("@"):
-        await update.message.reply_text("⚠️ Используйте: /confirm @username")
+    usage = "⚠️ Используйте: /confirm @username [@username ...] или /confirm all <название мероприятия>"
+    summary = []
+    buyers = {}
+    if context.args and context.args[0].lower() == "all":
+        parts = update.message.text.split(maxsplit=2)
+        event = event_catalog.get_by_title(parts[2].strip()) if len(parts) > 2 else None
+        if not event:
+            await update.message.reply_text(usage if len(parts) < 3 else "❌ Мероприятие не найдено.")
+            return
+        pending = payment_store.pending_for_event(event.id)
+        for payment in pending:
+            if payment['user_id'] not in buyers:
+                buyers[payment['user_id']] = user_db.get_user(user_id=payment['user_id']) or {'id': payment['user_id']}
+    else:
+        if not context.args or not all(arg.startswith("@") for arg in context.args):
+            await update.message.reply_text(usage)
+            return
+        pending = []
+        for username in dict.fromkeys(arg[1:] for arg in context.args):
+            buyer = user_db.get_user(username=username)
+            if not buyer:
+                summary.append(f"❌ @{username} — пользователь не найден")
+                continue
+            user_pending = payment_store.pending_for_user(buyer['id'])
+            if not user_pending:
+                summary.append(f"❌ @{username} — нет ожидающих покупок")
+                continue
+            buyers[buyer['id']] = buyer
+            pending.extend(user_pending)
+
+    # Заявки сразу переводятся в confirmed одной операцией: параллельная /confirm их уже не получит
+    claimed = payment_store.transition([p['id'] for p in pending], 'confirmed')
+    orders, sold_out, failed = await fulfil_payments(context.bot, claimed)
+
+    def name(user_id):
+        username = buyers.get(user_id, {}).get('username')
+        return f"@{username}" if username else f"id {user_id}"
+
+    bought = {}
+    for order in orders:
+        bought[order['user_id']] = bought.get(order['user_id'], 0) + order['qty']
+    for user_id, qty in bought.items():
+        user_db.update_user(user_id, 'tickets_bought', buyers[user_id].get('tickets_bought', 0) + qty)
+        if user_id in failed:
+            summary.append(f"⚠️ {name(user_id)} — {qty} билет(ов) сохранены, но не доставлены: {failed[user_id]}")
+        else:
+            summary.append(f"✅ {name(user_id)} — отправлено билетов: {qty}")
+    for payment in sold_out:
+        summary.append(
+            f"❌ {name(payment['user_id'])} — на «{payment['event_title']}» не осталось мест "
+            f"для {payment['qty']} билет(ов), оплату нужно вернуть"
+        )
+
+    if not claimed and not summary:
+        summary.append("❌ Нет ожидающих покупок.")
+
+    # Итог может не влезть в одно сообщение Telegram
+    text = ""
+    for line in summary:
+        if len(text) + len(line) + 1 > 4000:
+            await update.message.reply_text(text)
+            text = ""
+        text += line + "\n"
+    await update.message.reply_text(text)
+
+
+async def checkin_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_data = user_db.get_user(user_id=update.effective_user.id)
+    if not admin_data or not admin_data.get("is_admin"):
+        await update.message.reply_text("🚫 Только администратор может отмечать проход.")
         return
 
-    username = context.args[0][1:]
-    buyer = next((u for u in user_db.data['users'] if u.get("username") == username), None)
+    # Старые коды содержат пробелы из названия мероприятия, поэтому берём весь текст после команды
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("⚠️ Используйте: /checkin <код билета>")
+        return
 
-    if not buyer:
-        await update.message.reply_text("❌ Пользователь не найден.")
+    result = checkin_service.check_in([parts[1].strip()], gate=f"tg:{update.effective_user.id}")[0]
+    if result['status'] == 'invalid':
+        await update.message.reply_text("❌ Поддельный билет: подпись не совпадает.")
+    elif result['status'] == 'not_found':
+        await update.message.reply_text("❌ Билет не найден.")
+    elif result['status'] == 'already_checked_in':
+        await update.message.reply_text(
+            f"⚠️ Билет уже использован: {result['event_title']}, место #{result['seat']}, "
+            f"проход в {result['checked_in_at'][:19].replace('T', ' ')}."
+        )
+    else:
+        await update.message.reply_text(f"✅ Проход разрешён: {result['event_title']}, билет #{result['seat']}.")
+
+async def set_event_capacity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_data = user_db.get_user(user_id=update.effective_user.id)
+    if not admin_data or not admin_data.get("is_admin"):
+        await update.message.reply_text("🚫 Только администратор может менять вместимость.")
         return
 
-    user_id = buyer['id']
-    pending = [t for t in context.application.bot_data.get('pending_payments', []) if t['user_id'] == user_id]
+    parts = update.message.text.split(maxsplit=2)
+    if len(parts) < 3 or not parts[1].isdigit():
+        await update.message.reply_text("⚠️ Используйте: /capacity <число мест> <название мероприятия>")
+        return
 
-    if not pending:
-        await update.message.reply_text("❌ Нет ожидающих покупок у этого пользователя.")
+    event = event_catalog.get_by_title(parts[2].strip())
+    if not event:
+        await update.message.reply_text("❌ Мероприятие не найдено.")
         return
 
-    os.makedirs("tickets", exist_ok=True)
+    event_catalog.update_extra(event.id, {'capacity': int(parts[1])})
+    await update.message.reply_text(
+        f"✅ Вместимость «{event.title}»: {parts[1]} мест, свободно {reservations.available(event)}."
+    )
 
-    if not os.path.exists("tickets.json"):
-        tickets_data = {"tickets": []}
-    else:
-        with open("tickets.json", "r", encoding="utf-8") as f:
-            tickets_data = json.load(f)
 
-    for ticket_data in pending:
-        codes = []
-        for i in range(ticket_data['qty']):
-            code = f"{user_id}_{ticket_data['event_title']}_{i}_{datetime.now().timestamp()}"
-            codes.append(code)
-            qr_path = f"tickets/{code}.png"
-            qrcode.make(code).save(qr_path)
+async def set_waiting_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_data = user_db.get_user(user_id=update.effective_user.id)
+    if not admin_data or not admin_data.get("is_admin"):
+        await update.message.reply_text("🚫 Только администратор может настраивать очередь.")
+        return
 
-            with open(qr_path, 'rb') as f:
-                await context.bot.send_photo(chat_id=user_id, photo=f, caption=f"🎫 Билет #{i+1}")
+    parts = update.message.text.split(maxsplit=2)
+    if len(parts) < 3 or not parts[1].isdigit():
+        await update.message.reply_text("⚠️ Используйте: /waiting_room <покупателей в минуту, 0 — выключить> <название мероприятия>")
+        return
 
-        ticket_data['codes'] = codes
-        ticket_data['datetime'] = datetime.now().isoformat()
-        tickets_data["tickets"].append(ticket_data)
+    event = event_catalog.get_by_title(parts[2].strip())
+    if not event:
+        await update.message.reply_text("❌ Мероприятие не найдено.")
+        return
 
-    with open("tickets.json", "w", encoding="utf-8") as f:
-        json.dump(tickets_data, f, indent=4, ensure_ascii=False)
+    event_catalog.update_extra(event.id, {'waiting_room_rate': int(parts[1])})
+    if int(parts[1]):
+        await update.message.reply_text(f"✅ Очередь для «{event.title}»: {parts[1]} покупателей в минуту.")
+    else:
+        await update.message.reply_text(f"✅ Очередь для «{event.title}» выключена.")
 
-    context.application.bot_data['pending_payments'] = [
-        t for t in context.application.bot_data.get('pending_payments', []) if t['user_id'] != user_id
-    ]
-    buyer['tickets_bought'] = buyer.get('tickets_bought', 0) + sum(p['qty'] for p in pending)
-    user_db._save_data()
 
-    await update.message.reply_text(f"✅ Покупка подтверждена. Пользователю @{username} отправлены билеты.")
+async def export_checkin_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_data = user_db.get_user(user_id=update.effective_user.id)
+    if not admin_data or not admin_data.get("is_admin"):
+        await update.message.reply_text("🚫 Только администратор может выгружать списки для входа.")
+        return
 
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("⚠️ Используйте: /checkin_export <название мероприятия>")
+        return
 
+    event = event_catalog.get_by_title(parts[1].strip())
+    if not event:
+        await update.message.reply_text("❌ Мероприятие не найдено.")
+        return
+
+    snapshot = checkin_service.snapshot(event.title)
+    snapshot['event_id'] = event.id
+    data = json.dumps(snapshot, ensure_ascii=False).encode('utf-8')
+    await update.message.reply_document(
+        document=InputFile(BytesIO(data), filename=f"checkin_{event.id}.json"),
+        caption=f"📦 Снимок для сканеров: {snapshot['tickets_count']} билетов, "
+                f"{snapshot['checked_in_count']} уже прошли."
+    )
 
 
 def get_main_menu():
@@ -368,7 +2550,7 @@ async def open_profile(update, context):
     await delete_previous_messages(update, context)
 
     user_id = query.from_user.id
-    user = next((u for u in user_db.data['users'] if u['id'] == user_id), None)
+    user = user_db.get_user(user_id=user_id)
 
     if not user:
         message = await query.message.reply_text("❌ Пользователь не найден.")
@@ -453,27 +2635,29 @@ async def apply_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await delete_previous_messages(update, context)
 
     msg = await update.message.reply_text("✅ Данные обновлены. Возврат в профиль через 5 секунд...")
-    await asyncio.sleep(5)
 
-    try:
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg.message_id)
-    except:
-        pass
+    async def return_to_profile():
+        try:
+            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg.message_id)
+        except:
+            pass
 
-    class FakeCallbackQuery:
-        def __init__(self, user, message):
-            self.from_user = user
-            self.message = message
+        class FakeCallbackQuery:
+            def __init__(self, user, message):
+                self.from_user = user
+                self.message = message
 
-        async def answer(self):
-            pass
+            async def answer(self):
+                pass
 
-    fake_query_update = Update(
-        update_id=update.update_id,
-        callback_query=FakeCallbackQuery(update.effective_user, update.message)
-    )
+        fake_query_update = Update(
+            update_id=update.update_id,
+            callback_query=FakeCallbackQuery(update.effective_user, update.message)
+        )
+
+        await open_profile(fake_query_update, context)
 
-    await open_profile(fake_query_update, context)
+    run_later(context, update, 5, return_to_profile)
     return ConversationHandler.END
 
 async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -532,27 +2716,29 @@ async def apply_new_password(update, context):
 
     await delete_previous_messages(update, context)
     confirm_message = await update.message.reply_text("✅ Пароль успешно изменён. Возврат через 5 секунд...")
-    await asyncio.sleep(5)
 
-    try:
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirm_message.message_id)
-    except:
-        pass
+    async def return_to_settings():
+        try:
+            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=confirm_message.message_id)
+        except:
+            pass
 
-    class FakeCallbackQuery:
-        def __init__(self, user, message):
-            self.from_user = user
-            self.message = message
+        class FakeCallbackQuery:
+            def __init__(self, user, message):
+                self.from_user = user
+                self.message = message
 
-        async def answer(self):
-            pass
+            async def answer(self):
+                pass
 
-    fake_query_update = Update(
-        update_id=update.update_id,
-        callback_query=FakeCallbackQuery(update.effective_user, update.message)
-    )
+        fake_query_update = Update(
+            update_id=update.update_id,
+            callback_query=FakeCallbackQuery(update.effective_user, update.message)
+        )
 
-    await open_settings(fake_query_update, context)
+        await open_settings(fake_query_update, context)
+
+    run_later(context, update, 5, return_to_settings)
     return ConversationHandler.END
 
 
@@ -571,16 +2757,16 @@ async def login_password_input(update: Update, context: ContextTypes.DEFAULT_TYP
     email = context.user_data['login_email']
     context.user_data['messages_to_delete'].append(update.message.message_id)
 
-    for user in user_db.data['users']:
-        if user['email'] == email and user['password'] == hash_password(password):
-            await delete_previous_messages(update, context)
-            msg = await update.message.reply_text(
-                f"✅ Вы вошли как {user['fullname']}. Добро пожаловать в LumaMap!"
-                "\n\nВыберите действие:",
-                reply_markup=get_main_menu()
-            )
-            context.user_data['messages_to_delete'].append(msg.message_id)
-            return ConversationHandler.END
+    user = user_db.get_user(email=email)
+    if user and user['password'] == hash_password(password):
+        await delete_previous_messages(update, context)
+        msg = await update.message.reply_text(
+            f"✅ Вы вошли как {user['fullname']}. Добро пожаловать в LumaMap!"
+            "\n\nВыберите действие:",
+            reply_markup=get_main_menu()
+        )
+        context.user_data['messages_to_delete'].append(msg.message_id)
+        return ConversationHandler.END
 
     message = await update.message.reply_text("❌ Неверный email или пароль. Попробуйте снова.")
     context.user_data['messages_to_delete'].append(message.message_id)
@@ -714,28 +2900,30 @@ async def confirm_password(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     return ConversationHandler.END
 
-async def show_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def get_page_buttons(prev_data, next_data):
+    row = []
+    if prev_data:
+        row.append(InlineKeyboardButton("◀️ Предыдущие", callback_data=prev_data))
+    if next_data:
+        row.append(InlineKeyboardButton("Следующие ▶️", callback_data=next_data))
+    return row
+
+async def show_events(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
     await delete_previous_messages(update, context)
 
-    events = load_events()
     today = datetime.today().date()
 
-    upcoming = [event for event in events if datetime.strptime(event["date"], "%Y-%m-%d").date() >= today]
-
     filter_min = context.user_data.get("filter_min_price")
     filter_max = context.user_data.get("filter_max_price")
 
-    if filter_min is not None and filter_max is not None:
-        def parse_price(price_str):
-            digits = re.findall(r"\d+", price_str)
-            return int(digits[0]) if digits else 0
-
-        upcoming = [e for e in upcoming if filter_min <= parse_price(e.get("price", "0")) <= filter_max]
-
-    upcoming.sort(key=lambda e: e["date"])
+    upcoming, total = event_catalog.upcoming_page(today, page * FEED_PAGE_SIZE, FEED_PAGE_SIZE, filter_min, filter_max)
+    pages = max(1, -(-total // FEED_PAGE_SIZE))
+    if page >= pages:
+        page = pages - 1
+        upcoming, total = event_catalog.upcoming_page(today, page * FEED_PAGE_SIZE, FEED_PAGE_SIZE, filter_min, filter_max)
 
     user_id = update.effective_user.id
-    user = next((u for u in user_db.data['users'] if u['id'] == user_id), None)
+    user = user_db.get_user(user_id=user_id)
 
     keyboard = [
         [InlineKeyboardButton("🔎 Фильтр по цене", callback_data="open_price_filter")],
@@ -743,6 +2931,12 @@ async def show_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     if user and user.get('is_admin'):
         keyboard.insert(0, [InlineKeyboardButton("🎨 Создать постер", callback_data="create_event_poster")])
+    page_buttons = get_page_buttons(
+        f"events_page_{page - 1}" if page > 0 else None,
+        f"events_page_{page + 1}" if page + 1 < pages else None,
+    )
+    if page_buttons:
+        keyboard.insert(0, page_buttons)
 
     context.user_data['messages_to_delete'] = []
 
@@ -759,37 +2953,55 @@ async def show_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = await update.effective_chat.send_message(filter_text)
         context.user_data['messages_to_delete'].append(msg.message_id)
 
-    for i, event in enumerate(upcoming):
+    items = []
+    for event in upcoming:
         text = (
-            f"*{event['title']}*\n"
-            f"📅 Дата: {event['date']}\n"
-            f"📍 Место: {event['location']}\n"
-            f"💰 Цена: {event.get('price', 'Бесплатно')}\n"
-            f"📝 Oписание: \n{event['description']}"
+            f"*{event.title}*\n"
+            f"📅 Дата: {event.date_text}\n"
+            f"📍 Место: {event.location}\n"
+            f"💰 Цена: {event.price_text}\n"
+            f"📝 Oписание: \n{event.description}"
         )
      
         buttons = [
-            [InlineKeyboardButton("🎟 Купить билет", callback_data=f"buy_ticket_id_{event['id']}")]
+            [InlineKeyboardButton("🎟 Купить билет", callback_data=f"buy_ticket_id_{event.id}")]
         ]
 
-        if event.get("image") and os.path.exists(event["image"]):
-            with open(event["image"], "rb") as img:
-                msg = await update.effective_chat.send_photo(photo=img, caption=text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(buttons))
-        else:
-            msg = await update.effective_chat.send_message(text=text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(buttons))
-
+        items.append({
+            'event': event,
+            'text': text,
+            'image': event.image if event.image and os.path.exists(event.image) else None,
+            'cache': event.extra,
+            'parse_mode': "Markdown",
+            'reply_markup': InlineKeyboardMarkup(buttons),
+            'on_upload': lambda fresh, event_id=event.id: event_catalog.update_extra(event_id, fresh),
+        })
+
+    grouped_buttons = []
+    for item, msg, grouped in await send_feed(update.effective_chat, items):
         context.user_data['messages_to_delete'].append(msg.message_id)
-
-    menu_msg = await update.effective_chat.send_message("Меню опций:", reply_markup=InlineKeyboardMarkup(keyboard))
+        if grouped:
+            event = item['event']
+            grouped_buttons.append([InlineKeyboardButton(f"🎟 {event.title}", callback_data=f"buy_ticket_id_{event.id}")])
+    # Под альбомом кнопок нет, поэтому «Купить билет» переезжает в меню
+    keyboard[0:0] = grouped_buttons
+
+    menu_text = "Меню опций:" if pages == 1 else f"Меню опций (страница {page + 1} из {pages}):"
+    menu_msg = await update.effective_chat.send_message(menu_text, reply_markup=InlineKeyboardMarkup(keyboard))
     context.user_data['messages_to_delete'].append(menu_msg.message_id)
 
+async def show_events_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await show_events(update, context, page=int(query.data.split("_")[-1]))
+
 async def create_event_poster(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     await delete_previous_messages(update, context)
 
     user_id = query.from_user.id
-    user = next((u for u in user_db.data['users'] if u['id'] == user_id), None)
+    user = user_db.get_user(user_id=user_id)
 
     if not user or not user.get('is_admin'):
         message = await query.message.reply_text("🚫 У вас нет прав для создания постера.")
@@ -886,6 +3098,7 @@ async def handle_event_image(update, context):
         await file.download_to_drive(file_path)
 
         context.user_data['event_image'] = file_path
+        context.user_data['event_image_file_id'] = photo.file_id
 
     await save_event_and_back(update, context)
     return ConversationHandler.END
@@ -910,19 +3123,19 @@ async def skip_event_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def save_event_and_back(update, context):
     await delete_previous_messages(update, context)
 
-    events = load_events()
-    new_event = {
-        "id": str(uuid.uuid4()),
-        "title": context.user_data['event_title'],
-        "description": context.user_data['event_description'],
-        "date": context.user_data['event_date'],
-        "location": context.user_data['event_location'],
-        "image": context.user_data.get('event_image'),
-        "price": context.user_data.get("event_price", "Бесплатно")
-    }
-    events.append(new_event)
-    with open("events.json", "w", encoding="utf-8") as f:
-        json.dump({"events": events}, f, indent=4, ensure_ascii=False)
+    new_event = Event(
+        id=str(uuid.uuid4()),
+        title=context.user_data['event_title'],
+        description=context.user_data['event_description'],
+        date_text=context.user_data['event_date'],
+        location=context.user_data['event_location'],
+        image=context.user_data.get('event_image'),
+        price_text=context.user_data.get("event_price", "Бесплатно")
+    )
+    if new_event.image and context.user_data.get('event_image_file_id'):
+        new_event.extra['image_file_id'] = context.user_data['event_image_file_id']
+        new_event.extra['image_signature'] = image_signature(new_event.image)
+    save_event(new_event)
 
     context.user_data.clear()
 
@@ -987,20 +3200,56 @@ async def ask_ticket_quantity(update, context):
     await query.answer()
     await delete_previous_messages(update, context)
 
+    event = event_catalog.get(context.user_data.get("selected_event_id"))
+    room = get_waiting_room(event) if event else None
+    if room and not await room.enter(update.effective_user.id, update.effective_chat, context.bot):
+        return ConversationHandler.END
+
     msg = await query.message.reply_text("Введите количество билетов:")
     context.user_data['messages_to_delete'] = [msg.message_id]
     return CHOOSE_TICKET_QTY
 
+async def enter_from_waiting_room(update, context):
+    context.user_data['selected_event_id'] = update.callback_query.data.split("_")[-1]
+    return await ask_ticket_quantity(update, context)
+
+async def leave_waiting_room(update, context):
+    query = update.callback_query
+    await query.answer()
+    room = waiting_rooms.get(query.data.split("_")[-1])
+    if room:
+        room.leave(update.effective_user.id)
+    await query.edit_message_text("Вы вышли из очереди.")
+
 async def process_ticket_quantity(update, context):
-    qty = int(update.message.text)
     context.user_data['messages_to_delete'].append(update.message.message_id)
-    context.user_data['ticket_qty'] = qty
+    try:
+        qty = int(update.message.text.strip())
+    except ValueError:
+        qty = 0
+    if not 1 <= qty <= MAX_TICKETS_PER_ORDER:
+        msg = await update.message.reply_text(f"❌ Введите число от 1 до {MAX_TICKETS_PER_ORDER}:")
+        context.user_data['messages_to_delete'].append(msg.message_id)
+        return CHOOSE_TICKET_QTY
+
+    event = event_catalog.get(context.user_data["selected_event_id"])
+
+    previous_hold = context.user_data.pop('ticket_hold', None)
+    if previous_hold:
+        reservations.release(previous_hold)
+    hold_id = reservations.hold(event, update.effective_user.id, qty)
+    if not hold_id:
+        left = reservations.available(event)
+        msg = await update.message.reply_text(
+            f"😔 Осталось только {left} билет(ов). Введите другое количество:" if left
+            else "😔 Билеты на это мероприятие закончились."
+        )
+        context.user_data['messages_to_delete'].append(msg.message_id)
+        return CHOOSE_TICKET_QTY if left else ConversationHandler.END
 
-    events = load_events()
-    event = next((e for e in events if e["id"] == context.user_data["selected_event_id"]), None)
-    price_str = event.get("price", "0")
-    price = int(re.findall(r"\d+", price_str)[0]) if re.findall(r"\d+", price_str) else 0
-    total = qty * price
+    context.user_data['ticket_hold'] = hold_id
+    context.user_data['ticket_qty'] = qty
+    total = qty * event.price
     context.user_data['ticket_total_price'] = total
 
     keyboard = [[
@@ -1020,14 +3269,14 @@ async def start_whatsapp_payment(update, context):
 
     qty = context.user_data['ticket_qty']
     event_id = context.user_data['selected_event_id']
-    event = next((e for e in load_events() if e['id'] == event_id), None)
+    event = event_catalog.get(event_id)
 
     if not event:
         await query.message.reply_text("❌ Ошибка: мероприятие не найдено.")
         return
 
     fullname = update.effective_user.full_name
-    message_text = f"Здравствуйте! Я хочу купить {qty} билет(ов) на '{event['title']}' от {fullname}."
+    message_text = f"Здравствуйте! Я хочу купить {qty} билет(ов) на '{event.title}' от {fullname}."
 
     whatsapp_link = f"https://wa.me/77059821077?text={message_text.replace(' ', '%20')}"
 
@@ -1036,15 +3285,26 @@ async def start_whatsapp_payment(update, context):
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Открыть WhatsApp", url=whatsapp_link)]])
     )
 
-    context.application.bot_data.setdefault('pending_payments', []).append({
+    # Пока администратор подтверждает оплату, места остаются за покупателем
+    hold_id = context.user_data.pop('ticket_hold', None)
+    if hold_id:
+        reservations.extend(hold_id, PAYMENT_HOLD_TTL)
+
+    now = time.time()
+    payment_store.add({
+        "id": uuid.uuid4().hex,
+        "status": "pending",
+        "hold_id": hold_id,
+        "event_id": event.id,
         "user_id": update.effective_user.id,
-        "event_title": event['title'],
+        "event_title": event.title,
         "qty": qty,
-        "total": context.user_data['ticket_total_price']
+        "total": context.user_data['ticket_total_price'],
+        "created_at": now,
+        "expires_at": now + PAYMENT_HOLD_TTL,
     })
 
-    await asyncio.sleep(20)
-    await back_to_main(update, context)
+    run_later(context, update, 20, lambda: back_to_main(update, context))
 
 async def finalize_purchase(update, context):
     query = update.callback_query
@@ -1052,53 +3312,42 @@ async def finalize_purchase(update, context):
     await delete_previous_messages(update, context)
 
     user_id = update.effective_user.id
-    user = next((u for u in user_db.data['users'] if u['id'] == user_id), None)
-    events = load_events()
-    event = next((e for e in events if e["id"] == context.user_data["selected_event_id"]), None)
+    user = user_db.get_user(user_id=user_id)
+    event = event_catalog.get(context.user_data["selected_event_id"])
     qty = context.user_data['ticket_qty']
     total = context.user_data['ticket_total_price']
 
-    os.makedirs("tickets", exist_ok=True)
-    ticket_ids = []
-
     context.user_data.setdefault('messages_to_delete', [])
 
-    for i in range(qty):
-        ticket_code = f"{user_id}_{event['title']}_{i}_{datetime.now().timestamp()}"
-        ticket_ids.append(ticket_code)
-        qr = qrcode.make(ticket_code)
-        path = f"tickets/{ticket_code}.png"
-        qr.save(path)
-
-        with open(path, 'rb') as f:
-            photo_msg = await update.effective_chat.send_photo(photo=f, caption=f"🎫 Билет #{i+1}")
-            context.user_data['messages_to_delete'].append(photo_msg.message_id)
+    if not reservations.commit(context.user_data.pop('ticket_hold', None), event, user_id, qty):
+        await update.effective_chat.send_message("😔 Бронь истекла, а свободных мест уже нет.")
+        return ConversationHandler.END
 
+    order_id = new_order_id()
+    ticket_ids = [make_ticket_code(event.id, order_id, i) for i in range(qty)]
     ticket_data = {
+        "order_id": order_id,
+        "event_id": event.id,
         "user_id": user_id,
-        "event_title": event['title'],
+        "event_title": event.title,
         "qty": qty,
         "total": total,
         "codes": ticket_ids,
         "datetime": datetime.now().isoformat()
     }
 
-    if not os.path.exists("tickets.json"):
-        with open("tickets.json", "w", encoding="utf-8") as f:
-            json.dump({"tickets": [ticket_data]}, f, indent=4, ensure_ascii=False)
-    else:
-        with open("tickets.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-        data["tickets"].append(ticket_data)
-        with open("tickets.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+    # Места уже списаны, поэтому заказ сохраняем до отправки: если доставка упадёт,
+    # билеты останутся в «Мои билеты»
+    save_tickets([ticket_data])
+    user_db.update_user(user_id, 'tickets_bought', user.get('tickets_bought', 0) + qty)
 
-    user['tickets_bought'] = user.get('tickets_bought', 0) + qty
-    user_db._save_data()
+    qr_images = await render_ticket_qrs(ticket_ids)
+    for photo_msg in await deliver_tickets(context.bot, update.effective_chat.id, qr_images):
+        context.user_data['messages_to_delete'].append(photo_msg.message_id)
 
     keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]]
     text_msg = await update.effective_chat.send_message(
-        f"✅ Вы успешно купили {qty} билет(ов) на *{event['title']}*.",
+        f"✅ Вы успешно купили {qty} билет(ов) на *{event.title}*.",
         parse_mode="Markdown",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -1113,15 +3362,10 @@ async def show_my_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     today = datetime.today().date()
 
-    tickets = []
-    if os.path.exists("tickets.json"):
-        with open("tickets.json", "r", encoding="utf-8") as f:
-            tickets = json.load(f).get("tickets", [])
-
-    events = load_events()
-    future_events = {e['title']: e for e in events if datetime.strptime(e['date'], "%Y-%m-%d").date() >= today}
-
-    user_events = sorted({t["event_title"] for t in tickets if t["user_id"] == user_id and t["event_title"] in future_events})
+    user_events = sorted(
+        title for title in ticket_index.event_titles_for_user(user_id)
+        if (event := event_catalog.get_by_title(title)) and event.date >= today
+    )
 
     if not user_events:
         keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]]
@@ -1151,20 +3395,14 @@ async def show_tickets_for_event(update: Update, context: ContextTypes.DEFAULT_T
 
     selected_event_title = query.data.replace("tickets_event_", "")
 
-    with open("tickets.json", "r", encoding="utf-8") as f:
-        all_tickets = json.load(f)["tickets"]
-
-    events = load_events()
-    event = next((e for e in events if e["title"] == selected_event_title), None)
+    event = event_catalog.get_by_title(selected_event_title)
 
-    if not event or datetime.strptime(event["date"], "%Y-%m-%d").date() < today:
+    if not event or event.date < today:
         msg = await query.message.reply_text("❌ Это мероприятие уже прошло.")
         context.user_data['messages_to_delete'] = [msg.message_id]
         return
 
-    user_tickets = [
-        t for t in all_tickets if t["user_id"] == user_id and t["event_title"] == selected_event_title
-    ]
+    user_tickets = ticket_index.orders_for(user_id, selected_event_title)
 
     if not user_tickets:
         msg = await query.message.reply_text("❌ У вас нет билетов на это мероприятие.")
@@ -1174,49 +3412,67 @@ async def show_tickets_for_event(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data['messages_to_delete'] = []
 
     for ticket in user_tickets:
-        for i, code in enumerate(ticket["codes"], 1):
-            img_path = f"tickets/{code}.png"
-            if os.path.exists(img_path):
-                with open(img_path, "rb") as f:
-                    msg = await update.effective_chat.send_photo(photo=f, caption=f"🎟 Билет #{i}")
-                    context.user_data['messages_to_delete'].append(msg.message_id)
+        qr_images = await render_ticket_qrs(ticket["codes"])
+        for msg in await deliver_tickets(context.bot, update.effective_chat.id, qr_images, label="🎟"):
+            context.user_data['messages_to_delete'].append(msg.message_id)
 
     back_button = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="tickets")]])
     msg = await update.effective_chat.send_message("↩️ Вернуться назад", reply_markup=back_button)
     context.user_data['messages_to_delete'].append(msg.message_id)
 
-async def show_news(update, context):
+async def show_news(update, context, before=None, after=None):
     await delete_previous_messages(update, context)
 
     user_id = update.effective_user.id
-    user = next((u for u in user_db.data['users'] if u['id'] == user_id), None)
+    user = user_db.get_user(user_id=user_id)
 
     keyboard = []
     if user and user.get("is_admin"):
         keyboard.append([InlineKeyboardButton("✍️ Создать пост", callback_data="create_news_post")])
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")])
 
-    news_list = load_news()
+    news_page, has_older, has_newer = news_repo.page(FEED_PAGE_SIZE, before=before, after=after)
+    if not news_page and (before is not None or after is not None):
+        news_page, has_older, has_newer = news_repo.page(FEED_PAGE_SIZE)
     context.user_data['messages_to_delete'] = []
 
-    if not news_list:
+    if not news_page:
         msg = await update.effective_chat.send_message("❌ Пока нет новостей.", reply_markup=InlineKeyboardMarkup(keyboard))
         context.user_data['messages_to_delete'].append(msg.message_id)
         return
 
-    for news in news_list[::-1]:
-        caption = f"{news['description']}\n🕒 {news['datetime'][:16].replace('T', ' ')}"
-        if "image" in news and os.path.exists(news["image"]):
-            with open(news["image"], "rb") as img:
-                msg = await update.effective_chat.send_photo(photo=img, caption=caption)
-        else:
-            msg = await update.effective_chat.send_message(caption)
+    page_buttons = get_page_buttons(
+        f"news_newer_{news_page[0][0]}" if has_newer else None,
+        f"news_older_{news_page[-1][0]}" if has_older else None,
+    )
+    if page_buttons:
+        keyboard.insert(0, page_buttons)
 
+    items = []
+    for _, news in news_page:
+        caption = f"{news['description']}\n🕒 {news['datetime'][:16].replace('T', ' ')}"
+        items.append({
+            'text': caption,
+            'image': news["image"] if "image" in news and os.path.exists(news["image"]) else None,
+            'cache': news,
+            'on_upload': lambda fresh, key=news['datetime']: news_repo.update('datetime', key, fresh),
+        })
+
+    for _, msg, _ in await send_feed(update.effective_chat, items):
         context.user_data['messages_to_delete'].append(msg.message_id)
 
     menu_msg = await update.effective_chat.send_message("Меню новостей:", reply_markup=InlineKeyboardMarkup(keyboard))
     context.user_data['messages_to_delete'].append(menu_msg.message_id)
 
+async def show_news_page(update, context):
+    query = update.callback_query
+    await query.answer()
+    _, direction, cursor = query.data.split("_")
+    if direction == "older":
+        await show_news(update, context, before=int(cursor))
+    else:
+        await show_news(update, context, after=int(cursor))
+
 async def start_news_post(update, context):
     query = update.callback_query
     await query.answer()
@@ -1247,6 +3503,7 @@ async def handle_news_image(update, context):
         file_path = f"news_images/news_{update.message.from_user.id}_{datetime.now().strftime('%Y%m%d%H%M%S')}.jpg"
         await file.download_to_drive(file_path)
         context.user_data['news_image'] = file_path
+        context.user_data['news_image_file_id'] = photo.file_id
 
     await finalize_news_post(update, context)
     return ConversationHandler.END
@@ -1281,6 +3538,9 @@ async def finalize_news_post(update, context):
     }
     if image_path:
         post["image"] = image_path
+        if context.user_data.get("news_image_file_id"):
+            post["image_file_id"] = context.user_data["news_image_file_id"]
+            post["image_signature"] = image_signature(image_path)
 
     save_news(post)
 
@@ -1336,10 +3596,145 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+session_last_seen = {}
+session_stats = {'evicted_total': 0, 'capped_total': 0}
+# Поля user_data, которые можно выбросить в любой момент (фильтр цены просто сбросится)
+SESSION_DISPOSABLE_KEYS = ('filter_min_price', 'filter_max_price')
+# Размеры user_data пересчитываются при обходе сессий, а не на каждый запрос метрик
+session_sizes = {'user_data_bytes': 0, 'largest_user_data_bytes': 0}
+
+def user_data_size(data):
+    try:
+        return len(pickle.dumps(data))
+    except Exception:
+        return 0
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+async def track_session(update, context):
+    # Последняя группа хендлеров: отмечаем активность и подрезаем user_data после обработки апдейта
+    user = update.effective_user if isinstance(update, Update) else None
+    if not user:
+        return
+    session_last_seen[user.id] = time.monotonic()
+
+    data = context.user_data
+    messages = data.get('messages_to_delete')
+    if isinstance(messages, list) and len(messages) > SESSION_MAX_TRACKED_MESSAGES:
+        del messages[:-SESSION_MAX_TRACKED_MESSAGES]
+
+    if user_data_size(data) > SESSION_MAX_BYTES:
+        # Выкидываем только то, без чего хендлеры обойдутся; поля незавершённого диалога
+        # убираются лишь вместе с самим диалогом, иначе следующий шаг не найдёт своих данных
+        if isinstance(messages, list):
+            messages.clear()
+        for key in SESSION_DISPOSABLE_KEYS:
+            data.pop(key, None)
+        if user_data_size(data) > SESSION_MAX_BYTES:
+            await reset_session(update, context)
+        session_stats['capped_total'] += 1
+        print(f"user_data пользователя {user.id} превысил {SESSION_MAX_BYTES} байт и был урезан")
+
+async def reset_session(update, context):
+    user_id = update.effective_user.id
+    hold_id = context.user_data.get('ticket_hold')
+    if hold_id:
+        reservations.release(hold_id)
+    context.user_data.clear()
+    context.user_data['messages_to_delete'] = []
+    for group in context.application.handlers.values():
+        for handler in group:
+            if isinstance(handler, ConversationHandler):
+                for key in [k for k in handler._conversations if k and k[-1] == user_id]:
+                    del handler._conversations[key]
+    if update.effective_chat:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="⚠️ Слишком много данных в сессии, текущее действие отменено. Начните заново: /start"
+        )
+
+def evict_idle_sessions(application):
+    now = time.monotonic()
+    for user_id in list(application.user_data):
+        session_last_seen.setdefault(user_id, now)
+    idle = [user_id for user_id, seen in session_last_seen.items() if now - seen > SESSION_IDLE_TIMEOUT]
+    if not idle:
+        return idle
+
+    # Вместе с user_data сбрасываем и незавершённые диалоги, иначе шаг диалога не найдёт своих данных.
+    # С persistence сессия общая для всех воркеров, а таймер активности у каждого свой:
+    # выгружаем только память процесса, ничего не записывая в базу
+    idle_set = set(idle)
+    persistence = application.persistence
+    conversation_handlers = [
+        handler for group in application.handlers.values() for handler in group
+        if isinstance(handler, ConversationHandler)
+    ]
+    for user_id in idle:
+        del session_last_seen[user_id]
+        if persistence:
+            application._user_data.pop(user_id, None)
+            application._user_ids_to_be_updated_in_persistence.discard(user_id)
+        elif user_id in application.user_data:
+            application.drop_user_data(user_id)
+    for handler in conversation_handlers:
+        for key in [k for k in handler._conversations if k and k[-1] in idle_set]:
+            if persistence:
+                handler._conversations.data.pop(key, None)
+                handler._conversations._write_access_keys.discard(key)
+            else:
+                del handler._conversations[key]
+    if persistence:
+        persistence.forget_users(idle_set)
+    session_stats['evicted_total'] += len(idle)
+    return idle
+
+def measure_sessions(application):
+    sizes = [user_data_size(data) for data in application.user_data.values()]
+    session_sizes['user_data_bytes'] = sum(sizes)
+    session_sizes['largest_user_data_bytes'] = max(sizes, default=0)
+
+def session_memory_stats(application):
+    return {
+        **session_stats,
+        **session_sizes,
+        "users": len(application.user_data),
+        "tracked_users": len(session_last_seen),
+        "rss_bytes": current_rss(),
+    }
+
+async def session_eviction_loop(application):
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            evicted = evict_idle_sessions(application)
+            if evicted:
+                print(f"Выгружено неактивных сессий: {len(evicted)}")
+            if application.persistence:
+                users, conversations = application.persistence.sweep_idle(SESSION_IDLE_TIMEOUT, CONVERSATION_TIMEOUT)
+                if users or conversations:
+                    print(f"Удалено из базы сессий: {users} user_data, {conversations} диалогов")
+            measure_sessions(application)
+        except Exception as e:
+            print(f"Ошибка при выгрузке неактивных сессий: {e}")
+
+
 def configure_handlers(application):
     # application = Application.builder().token(TOKEN).build()
 
+    # С persistence состояния диалогов хранятся в общей базе и видны всем воркерам
+    persistent = application.persistence is not None
+    # Таймаут диалога — job конкретного воркера: сработав, он записал бы END в общую базу
+    # и оборвал диалог, продолженный на другом воркере. С persistence диалоги истекают в sweep_idle
+    conversation_timeout = None if persistent else CONVERSATION_TIMEOUT
+
     application.add_error_handler(error_handler)
+    application.add_handler(TypeHandler(Update, track_session), group=100)
 
     application.add_handler(CommandHandler('start', start))
 
@@ -1354,7 +3749,10 @@ def configure_handlers(application):
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="registration",
+        persistent=persistent,
+        conversation_timeout=conversation_timeout
     )
 
     login_handler = ConversationHandler(
@@ -1366,6 +3764,9 @@ def configure_handlers(application):
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
         per_chat=True,
+        name="login",
+        persistent=persistent,
+        conversation_timeout=conversation_timeout
     )
 
     edit_conv = ConversationHandler(
@@ -1379,7 +3780,10 @@ def configure_handlers(application):
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="edit_profile",
+        persistent=persistent,
+        conversation_timeout=conversation_timeout
     )
 
     change_password_conv = ConversationHandler(
@@ -1390,6 +3794,9 @@ def configure_handlers(application):
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
         per_chat=True,
+        name="change_password",
+        persistent=persistent,
+        conversation_timeout=conversation_timeout
     )
 
     create_event_handler = ConversationHandler(
@@ -1408,11 +3815,17 @@ def configure_handlers(application):
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="create_event",
+        persistent=persistent,
+        conversation_timeout=conversation_timeout
     )
 
     ticket_purchase_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(ask_ticket_quantity, pattern="^confirm_buy$")],
+        entry_points=[
+            CallbackQueryHandler(ask_ticket_quantity, pattern="^confirm_buy$"),
+            CallbackQueryHandler(enter_from_waiting_room, pattern="^waiting_buy_"),
+        ],
         states={
             CHOOSE_TICKET_QTY: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_ticket_quantity)],
             CONFIRM_PAYMENT: [CallbackQueryHandler(finalize_purchase, pattern="^finalize_purchase$")]
@@ -1420,6 +3833,9 @@ def configure_handlers(application):
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
         per_chat=True,
+        name="ticket_purchase",
+        persistent=persistent,
+        conversation_timeout=conversation_timeout
     )
 
     news_conv = ConversationHandler(
@@ -1434,7 +3850,10 @@ def configure_handlers(application):
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_user=True,
-        per_chat=True
+        per_chat=True,
+        name="news",
+        persistent=persistent,
+        conversation_timeout=conversation_timeout
     )
 
     application.add_handler(login_handler)
@@ -1455,19 +3874,35 @@ def configure_handlers(application):
     application.add_handler(CallbackQueryHandler(settings_support, pattern="^settings_support$"))
     application.add_handler(CallbackQueryHandler(toggle_notifications, pattern="^settings_notifications$"))
     application.add_handler(CallbackQueryHandler(show_events, pattern="^events$"))
+    application.add_handler(CallbackQueryHandler(show_events_page, pattern=r"^events_page_\d+$"))
     application.add_handler(CallbackQueryHandler(create_event_poster, pattern="^create_event_poster$"))
     application.add_handler(CallbackQueryHandler(open_price_filter, pattern="^open_price_filter$"))
     application.add_handler(CallbackQueryHandler(apply_price_filter, pattern="^filter_"))
     application.add_handler(CallbackQueryHandler(reset_price_filter, pattern="^reset_filter$"))
     application.add_handler(CallbackQueryHandler(start_ticket_purchase, pattern="^buy_ticket_"))
     application.add_handler(CallbackQueryHandler(ask_ticket_quantity, pattern="^confirm_buy$"))
+    application.add_handler(CallbackQueryHandler(leave_waiting_room, pattern="^waiting_leave_"))
     application.add_handler(CallbackQueryHandler(show_events, pattern="^events$"))
     application.add_handler(CallbackQueryHandler(finalize_purchase, pattern="^finalize_purchase$"))
     application.add_handler(CallbackQueryHandler(show_my_tickets, pattern="^tickets$"))
     application.add_handler(CallbackQueryHandler(show_tickets_for_event, pattern="^tickets_event_"))
     application.add_handler(CallbackQueryHandler(show_news, pattern="^news$"))
+    application.add_handler(CallbackQueryHandler(show_news_page, pattern=r"^news_(older|newer)_\d+$"))
     application.add_handler(CallbackQueryHandler(prompt_news_image_upload, pattern="^upload_news_image$"))
     application.add_handler(CallbackQueryHandler(start_whatsapp_payment, pattern="^pay_whatsapp$"))
     application.add_handler(CommandHandler("confirm", confirm_payment))
+    application.add_handler(CommandHandler("checkin", checkin_ticket))
+    application.add_handler(CommandHandler("checkin_export", export_checkin_snapshot))
+    application.add_handler(CommandHandler("capacity", set_event_capacity))
+    application.add_handler(CommandHandler("waiting_room", set_waiting_room))
 
-    return application
\ No newline at end of file
+    return application
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["migrate"]:
+        migrate_json_to_sqlite(SqliteStore(SQLITE_PATH))
+    else:
+        print("Использование: python LumaMapBot.py migrate")
@@ -1,51 +1,358 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from telegram import Update
-from telegram.ext import Application
+from telegram.ext import Application, BaseUpdateProcessor
 from dotenv import load_dotenv
 import os
 import asyncio
+import hmac
+import threading
+from collections import deque
 
 # Загружаем токен
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", f"https://assem-7duv.onrender.com/{TOKEN}")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# "pool" — своя ограниченная очередь и пул воркеров, "queue" — очередь Application
+UPDATE_MODE = os.getenv("UPDATE_MODE", "pool")
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Сколько апдейтов (разных пользователей) обрабатывается одновременно
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+
+# Ключ для сканеров на входе; без него HTTP-отметка прохода выключена
+CHECKIN_API_KEY = os.getenv("CHECKIN_API_KEY")
+CHECKIN_BATCH_LIMIT = int(os.getenv("CHECKIN_BATCH_LIMIT", "1000"))
+
+# Состояние диалогов и user_data: "sqlite" — общая база для всех воркеров, "memory" — только в памяти процесса
+PERSISTENCE = os.getenv("PERSISTENCE", "sqlite")
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "sessions.db")
+# Как часто накопленные изменения сессий пишутся в базу
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "1"))
 
 # Flask приложение
 app = Flask(__name__)
 
-# Telegram Application
-application = Application.builder().token(TOKEN).build()
-
 # Импорт хендлеров
-from LumaMapBot import configure_handlers
+from LumaMapBot import (
+    configure_handlers, qr_render_stats, checkin_service, event_catalog, waiting_rooms, payment_expiry_loop,
+    SqlitePersistence, session_eviction_loop, session_memory_stats,
+)
+
+
+class SharedStateApplication(Application):
+    async def process_update(self, update):
+        # Диалог мог продолжиться на другом воркере: подтягиваем его состояние до выбора хендлера
+        if isinstance(self.persistence, SqlitePersistence) and isinstance(update, Update):
+            await self.persistence.refresh_conversations(self, update)
+        await super().process_update(update)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Для UPDATE_MODE=queue: как и в UpdateWorkerPool, разные пользователи обрабатываются
+    # параллельно, а апдейты одного пользователя — по порядку. Своей очереди апдейт ждёт
+    # до того, как займёт слот, чтобы один пользователь не занял их все
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # user_id -> [lock, сколько апдейтов пользователя ждут или обрабатываются]
+        self._locks = {}
+
+    async def process_update(self, update, coroutine):
+        key = update_shard_key(update)
+        if key is None:
+            return await super().process_update(update, coroutine)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# Telegram Application
+builder = Application.builder().token(TOKEN).application_class(SharedStateApplication)
+if UPDATE_MODE == "queue":
+    builder = builder.concurrent_updates(PerUserUpdateProcessor(UPDATE_WORKERS))
+if PERSISTENCE == "sqlite":
+    builder = builder.persistence(SqlitePersistence(PERSISTENCE_PATH, update_interval=PERSISTENCE_FLUSH_INTERVAL))
+application = builder.build()
 configure_handlers(application)
 
+# Один event loop на воркер: живёт в отдельном потоке, чтобы httpx-соединения
+# бота переиспользовались между апдейтами, а Flask-поток не ждал обработку
+loop = asyncio.new_event_loop()
+loop_thread = threading.Thread(target=loop.run_forever, name="telegram-loop", daemon=True)
+loop_thread.start()
+
+_started = False
+_start_lock = threading.Lock()
+
+def run_in_loop(coro, timeout=None):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+def update_shard_key(update):
+    user = getattr(update, "effective_user", None)
+    if user:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat else None
+
+
+class UpdateWorkerPool:
+    def __init__(self, application, workers, maxsize):
+        self.application = application
+        self.workers = workers
+        self.maxsize = maxsize
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.tasks = []
+        # user_id -> апдейты этого пользователя, ждущие воркера, который уже его обрабатывает
+        self.active = {}
+        self.parked = 0
+        self.busy = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.peak_depth = 0
+
+    async def start(self):
+        for i in range(self.workers):
+            self.tasks.append(asyncio.create_task(self._worker(), name=f"update-worker-{i}"))
+
+    async def submit(self, update):
+        if self.queue.qsize() + self.parked >= self.maxsize:
+            self.rejected += 1
+            return False
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        self.peak_depth = max(self.peak_depth, self.queue.qsize() + self.parked)
+        return True
+
+    async def _process(self, update):
+        try:
+            await self.application.process_update(update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"Ошибка обработки апдейта: {e}")
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            key = update_shard_key(update)
+
+            # Пользователь уже обрабатывается другим воркером: отдаём апдейт ему,
+            # чтобы шаги одного диалога шли строго по порядку
+            if key is not None and key in self.active:
+                self.active[key].append(update)
+                self.parked += 1
+                self.queue.task_done()
+                continue
+
+            if key is not None:
+                self.active[key] = deque()
+            self.busy += 1
+            try:
+                await self._process(update)
+                while key is not None and self.active[key]:
+                    update = self.active[key].popleft()
+                    self.parked -= 1
+                    await self._process(update)
+            finally:
+                if key is not None:
+                    self.parked -= len(self.active.pop(key))
+                self.busy -= 1
+                self.queue.task_done()
+
+    def stats(self):
+        return {
+            "mode": "pool",
+            "queue_depth": self.queue.qsize() + self.parked,
+            "queue_max": self.maxsize,
+            "parked": self.parked,
+            "active_users": len(self.active),
+            "peak_depth": self.peak_depth,
+            "workers": self.workers,
+            "busy_workers": self.busy,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+update_pool = UpdateWorkerPool(application, UPDATE_WORKERS, UPDATE_QUEUE_SIZE) if UPDATE_MODE == "pool" else None
+
 # Асинхронный запуск и установка webhook
 async def startup():
     await application.initialize()
     await application.start()
-    await application.bot.set_webhook(url=f"https://assem-7duv.onrender.com/{TOKEN}")
+    if update_pool:
+        await update_pool.start()
+    application.create_task(payment_expiry_loop(application.bot), name="payment-expiry")
+    application.create_task(session_eviction_loop(application), name="session-eviction")
+    await application.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
     print("✅ Webhook установлен и бот запущен")
 
+def ensure_started():
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if not _started:
+            run_in_loop(startup())
+            _started = True
+
 @app.before_first_request
 def before_first_request():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(startup())
+    ensure_started()
 
 # Webhook обработка
 @app.route(f"/{TOKEN}", methods=["POST"])
 def telegram_webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
+    ensure_started()
+
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return "forbidden", 403
 
-    async def handle():
-        await application.process_update(update)
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or "update_id" not in data:
+        return "bad request", 400
+    update = Update.de_json(data, application.bot)
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(handle())
+    if update_pool:
+        # Отвечаем Telegram сразу, обработку забирает пул воркеров
+        if not run_in_loop(update_pool.submit(update)):
+            return "busy", 503
+    else:
+        # Апдейт уходит в очередь Application, обработка идёт в фоне на общем loop
+        loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
 
     return "ok"
 
+async def collect_loop_stats():
+    # Сессии и очереди меняются только на loop бота, поэтому и читаем их там
+    return {
+        "sessions": session_memory_stats(application),
+        "waiting_rooms": {event_id: room.stats() for event_id, room in waiting_rooms.items()},
+    }
+
+# Метрики очереди апдейтов
+@app.route("/metrics")
+def metrics():
+    if update_pool:
+        stats = update_pool.stats()
+    else:
+        stats = {
+            "mode": "queue",
+            "queue_depth": application.update_queue.qsize(),
+            "workers": application.update_processor.max_concurrent_updates,
+            "busy_workers": application.update_processor.current_concurrent_updates,
+        }
+    stats["qr_render"] = dict(qr_render_stats)
+    stats.update(run_in_loop(collect_loop_stats(), timeout=5))
+    return jsonify(stats)
+
+def checkin_authorized():
+    key = request.headers.get("X-Checkin-Key", "")
+    return bool(CHECKIN_API_KEY) and hmac.compare_digest(key, CHECKIN_API_KEY)
+
+async def run_checkin(codes, gate):
+    # Отметки выполняются на общем loop, там же, где их делает бот
+    return checkin_service.check_in(codes, gate)
+
+# Отметка прохода одного билета
+@app.route("/checkin", methods=["POST"])
+def checkin():
+    if not checkin_authorized():
+        return "forbidden", 403
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return "bad request", 400
+    code = data.get("code")
+    if not isinstance(code, str) or not code or not isinstance(data.get("gate"), (str, type(None))):
+        return "bad request", 400
+    return jsonify(run_in_loop(run_checkin([code], data.get("gate")))[0])
+
+# Пачка отметок от сканера, например после потери связи
+@app.route("/checkin/batch", methods=["POST"])
+def checkin_batch():
+    if not checkin_authorized():
+        return "forbidden", 403
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return "bad request", 400
+    codes = data.get("codes")
+    if not isinstance(codes, list) or not all(isinstance(c, str) and c for c in codes):
+        return "bad request", 400
+    if not isinstance(data.get("gate"), (str, type(None))):
+        return "bad request", 400
+    if len(codes) > CHECKIN_BATCH_LIMIT:
+        return f"too many codes (max {CHECKIN_BATCH_LIMIT})", 413
+    results = run_in_loop(run_checkin(codes, data.get("gate")))
+    return jsonify({"results": results})
+
+async def run_checkin_merge(records):
+    return checkin_service.merge(records)
+
+async def run_checkin_snapshot(event_id, tickets_since, checkins_since):
+    # Каталог мероприятий тоже читается только на loop бота
+    event = event_catalog.get(event_id)
+    if not event:
+        return None
+    snapshot = checkin_service.snapshot(event.title, tickets_since, checkins_since)
+    snapshot["event_id"] = event.id
+    return snapshot
+
+# Снимок (или дельта) билетов мероприятия для сканеров без связи
+@app.route("/checkin/snapshot/<event_id>")
+def checkin_snapshot(event_id):
+    if not checkin_authorized():
+        return "forbidden", 403
+    try:
+        tickets_since = int(request.args.get("tickets_since", 0))
+        checkins_since = int(request.args.get("checkins_since", 0))
+    except ValueError:
+        return "bad request", 400
+    snapshot = run_in_loop(run_checkin_snapshot(event_id, tickets_since, checkins_since))
+    if snapshot is None:
+        return "not found", 404
+    return jsonify(snapshot)
+
+# Загрузка отметок, сделанных сканером без связи
+@app.route("/checkin/import", methods=["POST"])
+def checkin_import():
+    if not checkin_authorized():
+        return "forbidden", 403
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("checkins"), list):
+        return "bad request", 400
+    records = data["checkins"]
+    if not all(
+        isinstance(r, dict) and isinstance(r.get("code"), str) and r["code"]
+        and all(isinstance(r.get(k), (str, type(None))) for k in ("checked_in_at", "gate"))
+        for r in records
+    ):
+        return "bad request", 400
+    if len(records) > CHECKIN_BATCH_LIMIT:
+        return f"too many check-ins (max {CHECKIN_BATCH_LIMIT})", 413
+    return jsonify(run_in_loop(run_checkin_merge(records)))
+
 # Корневая страница
 @app.route("/")
 def home():